@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+import os, sys
+import json
+import random
+import resource
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import matrix
+
+default_org_count = 20
+default_row_count = 1000
+default_extra_columns = 10
+default_column_width = 12
+default_validated_fraction = 0.5
+default_results_file = 'bench_results.json'
+
+def parse_cmd_args():
+    parser = ArgumentParser(description='times the matrix build against a '
+                                        'synthetic bucket')
+    parser.add_argument('--orgs',
+                        help='number of organizations to generate',
+                        type=int,
+                        default=default_org_count)
+    parser.add_argument('--rows',
+                        help='data rows per file',
+                        type=int,
+                        default=default_row_count)
+    parser.add_argument('--extra_columns',
+                        help='filler columns added to every file',
+                        type=int,
+                        default=default_extra_columns)
+    parser.add_argument('--column_width',
+                        help='characters per filler value',
+                        type=int,
+                        default=default_column_width)
+    parser.add_argument('--validated_fraction',
+                        help='fraction of orgs with a %s marker' % matrix.validation_file,
+                        type=float,
+                        default=default_validated_fraction)
+    parser.add_argument('--latency_ms',
+                        help='simulated round trip per request',
+                        type=float,
+                        default=0)
+    parser.add_argument('--fetch_workers',
+                        help='number of objects to download at once',
+                        type=int,
+                        default=matrix.default_fetch_workers)
+    parser.add_argument('--parse_processes',
+                        help='number of processes the pipeline parses with',
+                        type=int,
+                        default=0)
+    parser.add_argument('--seed',
+                        help='random seed for the generated bucket',
+                        type=int,
+                        default=0)
+    parser.add_argument('--output',
+                        help='file to save the results to',
+                        default=default_results_file)
+
+    return parser.parse_args()
+
+
+class LocalKey(object):
+    """Just enough of a boto key to stream an object"""
+
+    def __init__(self, data, latency):
+        self.data = data
+        self.size = len(data)
+        self.position = 0
+        self.latency = latency
+
+    def read(self, size=0):
+        if not self.position:
+            time.sleep(self.latency)
+        if not size:
+            size = self.size - self.position
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+class LocalBucket(object):
+
+    def __init__(self, objects, latency):
+        self.objects = objects
+        self.latency = latency
+
+    def get_key(self, key_name):
+        return LocalKey(self.objects[key_name], self.latency)
+
+class LocalConnection(object):
+
+    def __init__(self, objects, latency):
+        self.objects = objects
+        self.latency = latency
+
+    def get_bucket(self, bucket_name, validate=True):
+        return LocalBucket(self.objects, self.latency)
+
+class LocalS3Wrapper(object):
+    """Stand in for occlibs' S3_Wrapper serving objects from memory,
+    with an optional simulated round trip on every request"""
+
+    def __init__(self, objects, latency=0):
+        self.objects = objects
+        self.latency = latency
+        self.listing = [{'key_name': key_name,
+                         'size': len(data),
+                         'etag': '"%x"' % (hash(data) & 0xffffffff),
+                         'last_modified': None}
+                        for key_name, data in sorted(objects.iteritems())]
+
+    def connect_to_s3(self, object_store):
+        return LocalConnection(self.objects, self.latency)
+
+    def get_files_in_s3_bucket(self, conn, bucket_name):
+        time.sleep(self.latency)
+        return [dict(entry) for entry in self.listing]
+
+    def load_file(self, conn, bucket_name, key_name):
+        time.sleep(self.latency)
+        return self.objects[key_name]
+
+
+def generate_bucket(org_count=default_org_count,
+                    row_count=default_row_count,
+                    extra_columns=default_extra_columns,
+                    column_width=default_column_width,
+                    validated_fraction=default_validated_fraction,
+                    seed=0):
+    """Builds a bucket of org trees like the ones orgs submit, one tsv
+    per node in matrix.node_names, returning a dict of key to body"""
+    rand = random.Random(seed)
+    lookup_columns = sorted(set(column for columns in
+                                matrix.matrix_table_lookup.values()
+                                for column in columns))
+    filler_columns = ['field_%d' % column for column in range(extra_columns)]
+    header = ['submitter_id', 'type'] + lookup_columns + filler_columns
+    objects = {}
+    for org in range(org_count):
+        org_name = 'BPA_Org%d_P%04d' % (org, org % 3 + 1)
+        for node in matrix.node_names:
+            lines = ['\t'.join(header)]
+            if node == 'project':
+                lines.append('\t'.join(['BPA-Org%d-P%04d' % (org, org % 3 + 1),
+                                        node] +
+                                       ['x'] * (len(header) - 2)))
+            else:
+                for row in range(row_count):
+                    values = ['%s-%s-%d' % (org_name, node, row), node]
+                    values += [str(rand.randint(1, 20)) for column in lookup_columns]
+                    values += [''.join(rand.choice('ACGT')
+                                       for char in range(column_width))
+                               for column in filler_columns]
+                    lines.append('\t'.join(values))
+            objects['%s/%s.%s' % (org_name, node, matrix.file_type)] = \
+                '\n'.join(lines) + '\n'
+        if rand.random() < validated_fraction:
+            objects['%s/%s' % (org_name, matrix.validation_file)] = ''
+
+    return objects
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def timed(results, phase, func, *args, **kwargs):
+    """Runs func, recording its wall time and the peak RSS so far"""
+    start = time.time()
+    value = func(*args, **kwargs)
+    results['phases'][phase] = {'seconds': time.time() - start,
+                                'peak_rss_mb': peak_rss_mb()}
+    return value
+
+def fetch_object(backend, key_name):
+    return key_name, backend.read(key_name)
+
+def fetch_all(backend, tasks, workers):
+    pool = ThreadPool(max(1, workers))
+    try:
+        return dict(pool.imap_unordered(partial(fetch_object, backend),
+                                        [key_name for org_name, node, key_name
+                                         in tasks]))
+    finally:
+        pool.close()
+        pool.join()
+
+def parse_all(tasks, bodies):
+    return [matrix.summarize_data(node, bodies[key_name],
+                                  matrix.wanted_columns(node, True))
+            for org_name, node, key_name in tasks]
+
+def aggregate_all(tasks, summaries):
+    all_org_data = {}
+    for (org_name, node, key_name), summary in zip(tasks, summaries):
+        if org_name not in all_org_data:
+            all_org_data[org_name] = matrix.OrgAggregate()
+        all_org_data[org_name].add_file(node, summary)
+    return all_org_data
+
+def render_all(all_org_data, out_dir):
+    matrix.output_main_matrix_table(all_org_data,
+                                    os.path.join(out_dir, 'matrix.html'))
+    matrix.output_detailed_matrix_table(matrix.process_parsed_data(all_org_data),
+                                        os.path.join(out_dir, 'matrix2.html'))
+
+def run_benchmark(args):
+    objects = generate_bucket(args.orgs, args.rows, args.extra_columns,
+                              args.column_width, args.validated_fraction,
+                              args.seed)
+    backend = matrix.S3Backend(LocalS3Wrapper(objects, args.latency_ms / 1000.0),
+                               'bench', 'bench')
+    results = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'parameters': vars(args),
+               'objects': len(objects),
+               'bytes': sum(len(data) for data in objects.itervalues()),
+               'phases': {}}
+
+    files = timed(results, 'list', backend.list)
+    tasks = [(entry['key_name'].split('/')[0],
+              matrix.normalize_node_name(entry['key_name']),
+              entry['key_name'])
+             for entry in files
+             if matrix.file_type in entry['key_name']]
+    bodies = timed(results, 'fetch', fetch_all, backend, tasks,
+                   args.fetch_workers)
+    summaries = timed(results, 'parse', parse_all, tasks, bodies)
+    del bodies
+    all_org_data = timed(results, 'aggregate', aggregate_all, tasks, summaries)
+    out_dir = tempfile.mkdtemp()
+    try:
+        timed(results, 'render', render_all, all_org_data, out_dir)
+        # the same work the way a real run interleaves it
+        timed(results, 'pipeline', matrix.load_org_data, backend, files,
+              workers=args.fetch_workers,
+              collect_values=True,
+              parse_processes=args.parse_processes)
+    finally:
+        shutil.rmtree(out_dir)
+
+    results['rows'] = sum(summary['rows'] for summary in summaries)
+    for phase in ['parse', 'pipeline']:
+        seconds = results['phases'][phase]['seconds']
+        results['phases'][phase]['rows_per_second'] = \
+            results['rows'] / seconds if seconds else None
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+if __name__ == '__main__':
+    args = parse_cmd_args()
+    # keep the per file progress out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results = run_benchmark(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for phase in ['list', 'fetch', 'parse', 'aggregate', 'render', 'pipeline']:
+        timing = results['phases'][phase]
+        print '%-10s %8.3fs  peak RSS %7.1f MB' % (phase, timing['seconds'],
+                                                   timing['peak_rss_mb'])
+    print '%d rows, %.0f rows/sec parsed' % (results['rows'],
+        results['phases']['parse']['rows_per_second'] or 0)
+    with open(args.output, 'w') as out_file:
+        json.dump(results, out_file, indent=2, sort_keys=True)
+    print 'Results saved to %s' % args.output
@@ -1,11 +1,45 @@
 #!/usr/bin/env python
 
 import os, sys
-from occlibs.s3_wrapper import S3_Wrapper
-from argparse import ArgumentParser
-from collections import defaultdict
+import bz2
+import zlib
+import heapq
+import cPickle
+import csv
+import json
+import mmap
+import random
+from argparse import ArgumentParser, ArgumentTypeError
+from array import array
+from collections import defaultdict, deque, OrderedDict
 import shutil
+import sqlite3
+import tempfile
 import datetime
+import threading
+import time
+import Queue
+from contextlib import contextmanager
+from itertools import chain
+from StringIO import StringIO
+
+# decoding records is most of the work for json submissions, so use
+# a faster decoder when one is installed
+try:
+    import ujson as json_decoder
+    try:
+        # ujson before 2.0 rounds the floats it reads unless asked not
+        # to, and they would no longer match the same value in a tsv
+        json_decoder.loads('0.1', precise_float=True)
+        json_loads = lambda text: json_decoder.loads(text, precise_float=True)
+    except TypeError:
+        json_loads = json_decoder.loads
+except ImportError:
+    try:
+        import simplejson as json_decoder
+    except ImportError:
+        json_decoder = json
+    json_loads = json_decoder.loads
 
 node_names = [
     'aliquot',
@@ -167,10 +201,6 @@ potential_names = {
         ['submitted-copy-number-files',
          'submitted-copy-number-file',
          'submitted_copy_number_file'],
-    'slide_image':
-        ['slide-image',
-        'slide_images',
-        'slide-images'],
     'treatment':
         ['treatments']
 }
@@ -229,36 +259,287 @@ secondary_header_strings = {
 
 
 file_type = 'tsv'
+data_delimiters = {'tsv': '\t',
+                   'csv': ','}
+# newline delimited json submissions, one record per line
+json_file_extensions = ['json', 'ndjson', 'jsonl']
+# data files may be compressed, cases.tsv.gz, though what they are
+# compressed with is told from their first bytes
+compression_extensions = ['gz', 'bz2']
 validation_file = 'validated.status'
 validated_key = 'validated'
 
+default_fetch_workers = 8
+# an object read that gets nothing for this many seconds is given up
+# on and retried, up to default_fetch_retries times, waiting
+# default_retry_backoff seconds before the first retry and twice as
+# long before each one after, up to max_retry_backoff
+default_fetch_timeout = 300
+default_fetch_retries = 3
+default_retry_backoff = 1.0
+max_retry_backoff = 60.0
+# a second request for an object is only raised once this many first
+# chunk latencies are known, out of the last hedge_window objects
+min_hedge_samples = 20
+hedge_window = 1000
+# organization prefixes listed at once
+default_list_workers = 8
+read_chunk_size = 1024 * 1024
+# compressed bodies are fed to the decompressor this much at a time,
+# which bounds what it returns at once
+decompress_input_size = 64 * 1024
+# the format of a delimited file is worked out from this much of its start
+sniff_bytes = 16 * 1024
+# objects are read and parsed in blocks of about this many bytes,
+# which with the queue depth bounds the memory a run needs
+parse_block_size = 4 * 1024 * 1024
+# parsing in processes is only worth starting for runs fetching
+# at least this much
+min_process_parse_bytes = 64 * 1024 * 1024
+# how many items each stage of the ingest pipeline can have waiting
+default_queue_depth = 8
+default_parse_workers = 2
+queue_poll_seconds = 0.1
+default_cache_file = 'matrix_cache.pickle'
+# bumped whenever the layout of the cache changes
+cache_version = 2
+default_snapshot_file = 'matrix.json'
+# bumped whenever the layout of the snapshot changes
+snapshot_version = 1
+default_history_file = 'matrix_history.sqlite'
+# what a sharded run writes instead of the pages, filled in with the shard
+default_partial_file = 'matrix_partial_%d_of_%d.pickle'
+partial_version = 2
+# runs are kept this long, and thinned to the last run of each day
+# once they are older than history_daily_after_days
+default_history_keep_days = 365
+default_history_daily_after_days = 30
+default_slowest_objects = 10
+
+# distinct values of a secondary column are kept exactly up to this
+# many, past that only the sketch_size smallest value hashes are kept
+# to estimate how many there are, and sample_size of them are shown
+distinct_value_limit = 1000
+sketch_size = 256
+sample_size = 20
+
+# fields of the first project row used to name the organization
+project_fields = ['submitter_id', 'name']
+
+# field whose distinct values are counted with --unique_ids
+id_column = 'submitter_id'
+
+matrix_file_name = 'matrix.html'
+matrix_2_file_name = 'matrix2.html'
+nginx_loc = '/usr/share/nginx/html/'
+
 hardcoded_orgs = {
     #'Foundation Medicine P0001': '',
     #'PersonalGenome Beta1': 'FastQ w/o Metadata',
     'MSKCC P0001': 'Unsupported TSV'
 }
 
-def parse_cmd_args(s3_inst):
-    parser = ArgumentParser(s3_inst)
+def shard_arg(value):
+    """Parses a shard given as i/N, counting shards from 0"""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ArgumentTypeError('expected a shard as i/N, not %r' % value)
+    if not 0 <= index < count:
+        raise ArgumentTypeError('shard %d/%d is not between 0 and %d' %
+                                (index, count, count - 1))
+    return index, count
+
+def parse_cmd_args(argv=None, merge=False):
+    """Arguments of a run, or with merge of the merge command, run as
+    matrix.py merge PARTIAL... with the same options"""
+    parser = ArgumentParser(prog='matrix.py merge' if merge else None)
+    if merge:
+        parser.add_argument('partials',
+                            help='partial aggregate files written by --shard runs',
+                            nargs='+')
+    else:
+        parser.add_argument('--shard',
+                            help='only process the organizations of shard i of N, '
+                                 'writing a partial aggregate file for the merge command',
+                            type=shard_arg)
+        parser.add_argument('--partial_file',
+                            help='file a shard writes its aggregates to, defaults to %s' %
+                                 (default_partial_file % (0, 1)).replace('0_of_1', 'I_of_N'))
     parser.add_argument('--copy_file_to_server',
                         help='copies file to object store',
                         action='store_true')
     parser.add_argument('--create_secondary_matrix',
                         help='create the secondary matrix',
                         action='store_true')
+    parser.add_argument('--create_all_matrices',
+                        help='create the main and secondary matrix from one pass over the bucket',
+                        action='store_true')
+    parser.add_argument('--local_dir',
+                        help='read a local mirror of the bucket instead of the object store')
+    parser.add_argument('--fetch_workers',
+                        help='number of objects to download at once',
+                        type=int,
+                        default=default_fetch_workers)
+    parser.add_argument('--fetch_timeout',
+                        help='seconds an object read may go without data before it is retried, '
+                             '0 to wait forever',
+                        type=float,
+                        default=default_fetch_timeout)
+    parser.add_argument('--fetch_retries',
+                        help='times an object is retried before it is skipped',
+                        type=int,
+                        default=default_fetch_retries)
+    parser.add_argument('--retry_backoff',
+                        help='seconds before the first retry of an object, doubled for each one after',
+                        type=float,
+                        default=default_retry_backoff)
+    parser.add_argument('--hedge_percentile',
+                        help='raise a second request for an object whose first chunk takes '
+                             'longer than this percentile of the others, such as 95',
+                        type=float)
+    parser.add_argument('--list_workers',
+                        help='number of organization prefixes to list at once',
+                        type=int,
+                        default=default_list_workers)
+    parser.add_argument('--include_prefix',
+                        help='only read organizations whose prefix starts with this, can be repeated',
+                        action='append')
+    parser.add_argument('--exclude_prefix',
+                        help='skip organizations whose prefix starts with this, can be repeated',
+                        action='append')
+    parser.add_argument('--parse_workers',
+                        help='number of threads parsing fetched objects',
+                        type=int,
+                        default=default_parse_workers)
+    parser.add_argument('--queue_depth',
+                        help='number of blocks or objects each pipeline stage can have waiting',
+                        type=int,
+                        default=default_queue_depth)
+    parser.add_argument('--parse_processes',
+                        help='number of processes to parse with, 0 parses on the fetch threads',
+                        type=int,
+                        default=0)
+    if not merge:
+        parser.add_argument('--unique_ids', '--unique-ids',
+                            help='also count the distinct %s values of each node, '
+                                 'shown beside the row counts' % id_column,
+                            action='store_true')
+    parser.add_argument('--memory_budget', '--memory-budget',
+                        help='megabytes the organization aggregates may take before the '
+                             'least recently updated are spilled to disk',
+                        type=int)
+    parser.add_argument('--spill_dir',
+                        help='directory to spill aggregates to, defaults to the system '
+                             'temporary directory')
+    parser.add_argument('--metrics_json',
+                        help='write run metrics to this JSON file')
+    parser.add_argument('--metrics_prom',
+                        help='write run metrics to this Prometheus textfile collector file')
+    parser.add_argument('--slowest',
+                        help='number of slowest objects to list in the metrics',
+                        type=int,
+                        default=default_slowest_objects)
+    parser.add_argument('--snapshot_json',
+                        help='file to write the matrix counts and values to as JSON',
+                        default=default_snapshot_file)
+    parser.add_argument('--snapshot_csv',
+                        help='also write the matrix counts and values to this CSV file')
+    parser.add_argument('--no_snapshot', '--no-snapshot',
+                        help='do not write a snapshot of the matrices',
+                        action='store_true')
+    parser.add_argument('--history_db',
+                        help='SQLite database each run is added to, see the history command',
+                        default=default_history_file)
+    parser.add_argument('--no_history', '--no-history',
+                        help='do not add this run to the history database',
+                        action='store_true')
+    parser.add_argument('--history_keep_days',
+                        help='days to keep runs in the history database',
+                        type=int,
+                        default=default_history_keep_days)
+    parser.add_argument('--history_daily_after_days',
+                        help='days after which only the last run of each day is kept',
+                        type=int,
+                        default=default_history_daily_after_days)
+    parser.add_argument('--cache_file',
+                        help='file holding results of unchanged objects',
+                        default=default_cache_file)
+    parser.add_argument('--no_cache', '--no-cache',
+                        help='neither read nor update the result cache',
+                        action='store_true')
+    parser.add_argument('--rebuild_cache', '--rebuild-cache',
+                        help='ignore cached results and rebuild the cache',
+                        action='store_true')
 
     parser.set_defaults(print_list=False)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not merge and args.shard and args.cache_file == default_cache_file:
+        # shards may share a directory, and each drops the keys it
+        # didn't see from its cache
+        args.cache_file = '%s_%d_of_%d%s' % (os.path.splitext(default_cache_file)[0],
+                                             args.shard[0], args.shard[1],
+                                             os.path.splitext(default_cache_file)[1])
     
     return args
 
+def parse_history_args(argv):
+    """Arguments of the history command, run as
+    matrix.py history [--history_db FILE] {runs,series,diff} ..."""
+    parser = ArgumentParser(prog='matrix.py history',
+                            description='query the counts of earlier runs')
+    parser.add_argument('--history_db',
+                        help='SQLite database runs were added to',
+                        default=default_history_file)
+    commands = parser.add_subparsers(dest='command')
+    runs = commands.add_parser('runs', help='list the recorded runs')
+    runs.add_argument('--limit',
+                      help='number of most recent runs to list',
+                      type=int,
+                      default=20)
+    series = commands.add_parser('series',
+                                 help='counts of one column of an organization over time')
+    series.add_argument('org',
+                        help='organization, by bucket prefix or matrix name')
+    series.add_argument('column',
+                        help='matrix column, such as read_group')
+    series.add_argument('--since',
+                        help='only runs from this date on, as YYYY-MM-DD')
+    diff = commands.add_parser('diff',
+                               help='what changed between two runs')
+    diff.add_argument('old_run',
+                      help='run id to compare from, defaults to the run before new_run',
+                      type=int,
+                      nargs='?')
+    diff.add_argument('new_run',
+                      help='run id to compare to, defaults to the last run',
+                      type=int,
+                      nargs='?')
+
+    return parser.parse_args(argv)
+
 def parse_data_file(file_data=None,
                     data_type=None,
-                    custom_delimiter=None):
+                    custom_delimiter=None,
+                    columns=None,
+                    distinct=False,
+                    stats=None,
+                    text_format=None):
     """Processes loaded data as a tsv, csv, or
-    json, returning it as a list of dicts"""
+    json, returning it as a list of dicts. The data can be one string
+    or an iterable of chunks of the body, which is read a line at a
+    time without ever being joined, and may be gzip or bz2 compressed.
+    A tsv or csv is read with text_format, or one sniffed from the
+    start of the data. With columns, only those columns are kept in
+    each dict. With distinct as well, the values of each column are
+    collected into a set instead, returning the number of rows and
+    a dict of the sets. The number of lines and skipped lines are
+    put in stats if given"""
     key_data = []
     header = None
+    positions = None
+    row_count = 0
+    line_count = 0
     skipped_lines = 0
     delimiters = {  'tsv': '\t',
                     'csv': ',',
@@ -281,36 +562,818 @@ def parse_data_file(file_data=None,
         else:
             delimiter = delimiters[data_type]
 
+        if isinstance(file_data, basestring):
+            file_data = [file_data]
+        file_data = decompress_chunks(file_data)
+
         if data_type == 'json':
-            for line in file_data.split('\n'):
-                line_data = json.loads(line)
-                key_data.append(line_data)
+            if distinct:
+                key_data = dict((column, set()) for column in columns or [])
+            for record in iter_json_records(file_data):
+                line_count += 1
+                if record is None:
+                    skipped_lines += 1
+                    continue
+                if columns is not None:
+                    line_data = {}
+                    for column in columns:
+                        value = record.get(column)
+                        if value is not None:
+                            line_data[column] = json_field_value(value)
+                else:
+                    line_data = record
+                if distinct:
+                    for column, value in line_data.iteritems():
+                        key_data[column].add(value)
+                else:
+                    key_data.append(line_data)
+                row_count += 1
         # load as tsv/csv, assuming the first row is the header
         # that provides keys for the dict
         else:
-            for line in file_data.split('\n'):
-                if delimiter in line:
-                    if len(line.strip('\n').strip()):
-                        if not header:
-                            header = line.strip('\n').split(delimiter)
-                        else:
-                            line_data = dict(zip(header, line.strip('\n')\
-                                                        .split(delimiter)))
-                            key_data.append(line_data)
+            if text_format is None:
+                file_data, text_format = sniff_chunks(file_data, delimiter)
+            row_stats = {}
+            for fields in iter_rows(file_data, text_format, row_stats):
+                if not header:
+                    header = fields
+                    if columns is not None:
+                        # a repeated column name takes the last of
+                        # its positions the row reaches, the same
+                        # as building the dict
+                        positions = []
+                        for column in columns:
+                            column_positions = [position for position, name
+                                                in enumerate(header)
+                                                if name == column]
+                            if column_positions:
+                                positions.append((column,
+                                                  max(column_positions),
+                                                  sorted(column_positions,
+                                                         reverse=True)))
+                        if distinct:
+                            key_data = dict((column, set())
+                                            for column in columns)
+                elif positions is None:
+                    line_data = dict(zip(header, fields))
+                    key_data.append(line_data)
                 else:
-                    # ok, let's see if we can be smart here
-                    #if not header:
-                    #    remaining_chars = set([c for c in line if not c.isalnum()])
-                    skipped_lines += 1
-
-    print '%d lines in file, %d processed' % (len(file_data.split('\n')), len(key_data))
+                    line_data = {}
+                    for column, last_position, column_positions in positions:
+                        if last_position < len(fields):
+                            line_data[column] = fields[last_position]
+                        else:
+                            for position in column_positions:
+                                if position < len(fields):
+                                    line_data[column] = fields[position]
+                                    break
+                    if distinct:
+                        for column, value in line_data.iteritems():
+                            key_data[column].add(value)
+                    else:
+                        key_data.append(line_data)
+                row_count += 1
+            line_count = row_stats['lines']
+            skipped_lines = row_stats['skipped']
+
+    # the header line isn't a row
+    if header:
+        row_count -= 1
+    print '%d lines in file, %d processed' % (line_count, row_count)
+    if stats is not None:
+        stats['lines'] = line_count
+        stats['skipped'] = skipped_lines
+    if distinct:
+        if not isinstance(key_data, dict):
+            key_data = dict((column, set()) for column in columns or [])
+        return row_count, key_data
     return key_data
 
+def is_json_document(chunks):
+    """Whether a json body is one document, an array of records,
+    rather than newline delimited records"""
+    for chunk in chunks:
+        start = chunk.lstrip()
+        if start:
+            return start.startswith('[')
+    return False
+
+def iter_json_records(chunks):
+    """Yields the records of a json body, one per line, or those of
+    an array when the body is one document. Lines that aren't an
+    object are yielded as None"""
+    # only as much of the body as shows which it is is read ahead
+    chunks = iter(chunks)
+    start = []
+    for chunk in chunks:
+        start.append(chunk)
+        if chunk.strip():
+            break
+    chunks = chain(start, chunks)
+    if is_json_document(start):
+        # an array has to be decoded in one go
+        for record in json_loads(''.join(chunks)):
+            yield record if isinstance(record, dict) else None
+        return
+    for line in iter_lines(chunks):
+        record = None
+        if line.strip():
+            try:
+                record = json_loads(line)
+            except ValueError:
+                pass
+        yield record if isinstance(record, dict) else None
+
+def json_field_value(value):
+    """A json field the way it would read in a tsv, so values from
+    both kinds of submission can be collected together"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, float):
+        # str() keeps only 12 significant digits
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    return json.dumps(value, sort_keys=True)
+
+def strip_compression(name):
+    """A key or file name without its compression extension, if any"""
+    base, dot, extension = name.rpartition('.')
+    if dot and extension.lower() in compression_extensions:
+        return base
+    return name
+
+def key_data_type(key_name):
+    """The kind of data file a key holds, or None if it isn't one"""
+    if file_type in key_name:
+        return file_type
+    if strip_compression(key_name).rpartition('.')[2].lower() in json_file_extensions:
+        return 'json'
+    return None
+
+def sniff_compression(data):
+    """gzip or bz2 if data starts with the magic bytes of one, or None"""
+    if data.startswith('\x1f\x8b'):
+        return 'gzip'
+    # the signature, block size, then the magic of a block or of the
+    # end of an empty stream
+    if data.startswith('BZh') and data[3:4].isdigit() and \
+            data[4:10] in ['1AY&SY', '\x17rE8P\x90']:
+        return 'bz2'
+    return None
+
+def decompressor(compression):
+    if compression == 'gzip':
+        # expects the gzip header and trailer around the deflate stream
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+def iter_decompressed(chunks, compression, chunk_size=read_chunk_size):
+    """Yields the decompressed body of compressed chunks in chunks of
+    about chunk_size. Streams one after another, as parallel
+    compressors write them, are read as one body, and zero bytes
+    padding the end of a stream are passed over as gzip does"""
+    decompress = decompressor(compression)
+    pieces = []
+    size = 0
+    for chunk in chunks:
+        for start in xrange(0, len(chunk), decompress_input_size):
+            data = chunk[start:start + decompress_input_size]
+            while data:
+                try:
+                    piece = decompress.decompress(data)
+                except EOFError:
+                    # a bz2 stream ended just before this data
+                    data = data.lstrip('\0')
+                    if data:
+                        decompress = decompressor(compression)
+                    continue
+                data = decompress.unused_data.lstrip('\0')
+                if data:
+                    decompress = decompressor(compression)
+                if piece:
+                    pieces.append(piece)
+                    size += len(piece)
+            if size >= chunk_size:
+                yield ''.join(pieces)
+                pieces = []
+                size = 0
+    if hasattr(decompress, 'flush'):
+        pieces.append(decompress.flush())
+    if any(pieces):
+        yield ''.join(pieces)
+
+def decompress_chunks(chunks, chunk_size=read_chunk_size):
+    """The chunks of a body, decompressed as they are read if they
+    start with the magic bytes of gzip or bz2, otherwise as they are"""
+    if isinstance(chunks, list):
+        first = chunks[0] if chunks else ''
+    else:
+        chunks = iter(chunks)
+        first = next(chunks, '')
+        chunks = chain([first], chunks)
+    compression = sniff_compression(first)
+    if compression is None:
+        return chunks
+    return iter_decompressed(chunks, compression, chunk_size)
+
+def read_chunks(handle, chunk_size=read_chunk_size, stats=None):
+    """Yields the body of an open object in chunks, closing it once
+    it has been read. The bytes read and the time spent reading are
+    added up in stats if given"""
+    try:
+        while True:
+            start = time.time()
+            chunk = handle.read(chunk_size)
+            if stats is not None:
+                stats['fetch_seconds'] += time.time() - start
+                stats['bytes'] += len(chunk)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        handle.close()
+
+def read_blocks(chunks, block_size=parse_block_size, quotechar=None):
+    """Yields a body read in chunks in blocks of whole lines of at
+    least block_size bytes, except for the last one. Each block is
+    a list of the chunks read, split at the last newline, so the body
+    is never copied into one string. With a quotechar, newlines inside
+    quoted fields are not split at"""
+    block = []
+    size = 0
+    quotes = 0
+    for chunk in chunks:
+        block.append(chunk)
+        size += len(chunk)
+        end = 0
+        if size >= block_size:
+            end = chunk.rfind('\n') + 1
+            if quotechar and end:
+                # an odd number of quotes before a newline means it
+                # is inside a quoted field, look further back
+                inside = (quotes + chunk.count(quotechar, 0, end)) % 2
+                while end and inside:
+                    previous = chunk.rfind('\n', 0, end - 1) + 1
+                    inside = (inside + chunk.count(quotechar, previous, end)) % 2
+                    end = previous
+        if end:
+            block[-1] = chunk[:end]
+            yield block
+            block = [chunk[end:]] if end < len(chunk) else []
+            size = len(chunk) - end
+            quotes = chunk.count(quotechar, end) if quotechar else 0
+        elif quotechar:
+            quotes += chunk.count(quotechar)
+    if size:
+        yield block
+
+class TextFormat(object):
+    """How a delimited file is written, as worked out by sniff_format.
+    Only files with quoted fields are read with the csv module, the
+    rest have their lines split, which gives the same fields quicker.
+    A file with no delimiters has a single column"""
+
+    def __init__(self, delimiter, quotechar=None, single_column=False):
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.single_column = single_column
+
+    def records(self, lines):
+        """The fields of each record in an iterable of lines"""
+        if self.quotechar:
+            return csv.reader((line + '\n' for line in lines),
+                              delimiter=self.delimiter,
+                              quotechar=self.quotechar,
+                              doublequote=True)
+        return (line.split(self.delimiter) for line in lines)
+
+    def is_row(self, fields):
+        """Whether a record holds a row, rather than being blank or a
+        stray line without the delimiter"""
+        if len(fields) > 1:
+            # a line of only whitespace delimiters is blank
+            return bool(self.delimiter.strip() or ''.join(fields).strip())
+        return self.single_column and bool(fields and fields[0].strip())
+
+def sniff_format(sample, delimiter):
+    """Works out the format of a delimited file from the start of it,
+    whether any fields are quoted and if it only has the one column"""
+    sample = sample[:sniff_bytes]
+    lines = sample.split('\n')
+    quotechar = None
+    if any(line.startswith('"') or delimiter + '"' in line for line in lines):
+        quotechar = '"'
+    single_column = bool(sample.strip()) and delimiter not in sample
+    return TextFormat(delimiter, quotechar, single_column)
+
+def sniff_chunks(chunks, delimiter):
+    """Sniffs the format of a body from its first chunk, returning the
+    chunks, with that one put back, and the format"""
+    chunks = iter(chunks)
+    first = next(chunks, '')
+    return chain([first], chunks), sniff_format(first, delimiter)
+
+def iter_rows(chunks, text_format, stats=None):
+    """Yields the header and then every row of a delimited body as a
+    list of fields. Lines that aren't rows are skipped, and the number
+    of lines and skipped lines are put in stats if given"""
+    line_count = 0
+    skipped_lines = 0
+    # the same checks as is_row, which are too slow to call per row
+    delimiter = text_format.delimiter
+    whitespace_delimiter = not delimiter.strip()
+    single_column = text_format.single_column
+    quoted = bool(text_format.quotechar)
+    if quoted:
+        records = text_format.records(iter_lines(chunks))
+    else:
+        # splitting here saves going through another generator
+        records = iter_lines(chunks)
+    for fields in records:
+        if not quoted:
+            fields = fields.split(delimiter)
+        line_count += 1
+        if len(fields) > 1:
+            if not whitespace_delimiter or ''.join(fields).strip():
+                yield fields
+        elif single_column and fields and fields[0].strip():
+            yield fields
+        else:
+            skipped_lines += 1
+    if quoted:
+        # quoted fields can span lines
+        line_count = records.line_num
+    if stats is not None:
+        stats['lines'] = line_count
+        stats['skipped'] = skipped_lines
+
+def find_header(chunks, text_format):
+    """Returns the line of a block parse_data_file would take as the
+    header of a tsv or csv, if there is one"""
+    for line in iter_lines(chunks):
+        for fields in text_format.records([line]):
+            if text_format.is_row(fields):
+                return line
+    return None
+
+def iter_lines(chunks):
+    """Splits a stream of chunks into lines, carrying partial
+    lines over chunk boundaries the same way splitting the whole
+    body on newlines would"""
+    remainder = ''
+    for chunk in chunks:
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+    yield remainder
+
+def count_data_rows(chunks=None,
+                    data_type=None,
+                    custom_delimiter=None,
+                    stats=None,
+                    text_format=None):
+    """Counts the data rows parse_data_file would return for a
+    tsv or csv, reading the data as a stream of chunks and
+    without keeping any of the rows. The number of lines and
+    skipped lines are put in stats if given"""
+    delimiters = {  'tsv': '\t',
+                    'csv': ','}
+
+    if data_type == 'other' and custom_delimiter:
+        delimiter = custom_delimiter
+    elif data_type in delimiters:
+        delimiter = delimiters[data_type]
+    else:
+        print "Unable to count rows for data type %s" % data_type
+        raise ValueError(data_type)
+
+    if text_format is None:
+        chunks, text_format = sniff_chunks(chunks, delimiter)
+    total_lines = 0
+    row_count = 0
+    skipped_lines = 0
+    if text_format.quotechar or text_format.single_column:
+        row_stats = {}
+        for fields in iter_rows(chunks, text_format, row_stats):
+            row_count += 1
+        total_lines = row_stats['lines']
+        skipped_lines = row_stats['skipped']
+    else:
+        # unquoted rows can be told apart without splitting them
+        for line in iter_lines(chunks):
+            total_lines += 1
+            if delimiter in line:
+                if len(line.strip()):
+                    row_count += 1
+            else:
+                skipped_lines += 1
+    # the first row is the header
+    row_count = max(row_count - 1, 0)
+
+    print '%d lines in file, %d processed' % (total_lines, row_count)
+    if stats is not None:
+        stats['lines'] = total_lines
+        stats['skipped'] = skipped_lines
+    return row_count
+
+def summarize_rows(node_data_type, rows, columns):
+    """Reduces the parsed rows of one file to its summary: the row
+    count, the distinct values of the given columns and, for projects,
+    the fields of the first row naming the organization"""
+    summary = {'rows': len(rows),
+               'columns': list(columns),
+               'values': {},
+               'skipped': 0}
+    for column in columns:
+        values = set(row[column] for row in rows if column in row)
+        if values:
+            summary['values'][column] = DistinctValues(values)
+    if node_data_type == 'project' and rows:
+        summary['first_row'] = dict((field, rows[0][field])
+                                    for field in project_fields
+                                    if field in rows[0])
+
+    return summary
+
+def count_summary(rows, columns=(), values=None):
+    """Summary of a file from its row count and, when given, the
+    distinct values collected for columns"""
+    summary = {'rows': rows,
+               'columns': list(columns),
+               'values': {},
+               'skipped': 0}
+    for column, column_values in (values or {}).iteritems():
+        if column == id_column:
+            summary['ids'] = IdHashSet(column_values)
+        elif column_values:
+            summary['values'][column] = DistinctValues(column_values)
+
+    return summary
+
+hash_mask = 2 ** 64 - 1
+
+def value_hash(value):
+    """A 64 bit hash of a value, the same in every process. Python's
+    own hash of similar strings, such as numbered ids, is far from
+    evenly spread, so it is put through the MurmurHash3 finalizer"""
+    mixed = hash(value) & hash_mask
+    mixed ^= mixed >> 33
+    mixed = (mixed * 0xff51afd7ed558ccd) & hash_mask
+    mixed ^= mixed >> 33
+    mixed = (mixed * 0xc4ceb9fe1a85ec53) & hash_mask
+    mixed ^= mixed >> 33
+    return mixed
+
+class DistinctValues(object):
+    """The distinct values of a column, held as a set until there are
+    more than distinct_value_limit. Past that the values with the
+    sketch_size smallest hashes are kept instead, a bottom-k sketch
+    that estimates how many there are and doubles as an unbiased
+    sample of them, so memory stays fixed however many rows there are"""
+    __slots__ = ['values', 'sketch']
+
+    def __init__(self, values=()):
+        self.values = set()
+        # hash to value, only once approximate
+        self.sketch = None
+        self.update(values)
+
+    def __getstate__(self):
+        return self.values, self.sketch
+
+    def __setstate__(self, state):
+        self.values, self.sketch = state
+
+    @property
+    def approximate(self):
+        return self.sketch is not None
+
+    def add(self, value):
+        self.update([value])
+
+    def update(self, values):
+        if isinstance(values, DistinctValues):
+            if values.sketch is not None:
+                self.to_sketch()
+                self.merge_sketch(values.sketch)
+                return
+            values = values.values
+        if self.sketch is None:
+            self.values.update(values)
+            if len(self.values) > distinct_value_limit:
+                self.to_sketch()
+        else:
+            self.merge_sketch(dict(zip(map(value_hash, values), values)))
+
+    def memory_size(self):
+        """Rough bytes held, for the memory budget"""
+        if self.sketch is None:
+            return sys.getsizeof(self.values) + sum(map(sys.getsizeof, self.values))
+        return sys.getsizeof(self.sketch) + sum(map(sys.getsizeof, self.sketch.itervalues()))
+
+    def to_sketch(self):
+        if self.sketch is None:
+            self.sketch = {}
+            self.merge_sketch(dict(zip(map(value_hash, self.values), self.values)))
+            self.values = None
+
+    def merge_sketch(self, hashed):
+        hashed.update(self.sketch)
+        self.sketch = dict((value_hash, hashed[value_hash]) for value_hash in
+                           heapq.nsmallest(sketch_size, hashed))
+
+    def __len__(self):
+        if self.sketch is None:
+            return len(self.values)
+        if len(self.sketch) < sketch_size:
+            return len(self.sketch)
+        # hashes are spread evenly over the 64 bit range, the k-th
+        # smallest falls about k / n of the way along it
+        return int((sketch_size - 1) * 2.0 ** 64 / (max(self.sketch) + 1))
+
+    def __iter__(self):
+        """The values, or a sample of them once approximate"""
+        if self.sketch is None:
+            return iter(self.values)
+        return iter([self.sketch[value_hash] for value_hash in
+                     sorted(self.sketch)[:sample_size]])
+
+    def __repr__(self):
+        if self.sketch is None:
+            return 'DistinctValues(%r)' % sorted(self.values)
+        return 'DistinctValues(~%d distinct)' % len(self)
+
+class IdHashSet(object):
+    """The distinct values of an id column, kept as their hashes in an
+    open addressing table backed by an array of machine words, 16 to
+    32 bytes an id on 64 bit builds rather than a string in a set.
+    Ids whose hashes collide are counted once, which with 64 bit
+    hashes doesn't happen at any size we see. Hashes being added are
+    held in a plain array until there are enough to be worth putting
+    in the table, so a block's ids are only ever hashed in once"""
+    __slots__ = ['table', 'size', 'pending']
+
+    def __init__(self, ids=()):
+        self.table = array('l', [0]) * 8
+        self.size = 0
+        hashes = set(map(hash, ids))
+        # 0 marks an empty slot, and no string hashes to -1
+        if 0 in hashes:
+            hashes.discard(0)
+            hashes.add(-1)
+        self.pending = array('l', hashes)
+
+    def __getstate__(self):
+        return self.table, self.size, self.pending
+
+    def __setstate__(self, state):
+        self.table, self.size, self.pending = state
+
+    def resize(self, capacity):
+        hashes = [id_hash for id_hash in self.table if id_hash]
+        size = len(self.table)
+        while size < capacity:
+            size *= 2
+        self.table = array('l', [0]) * size
+        self.size = 0
+        self.insert(hashes)
+
+    def insert(self, hashes):
+        """Puts non-zero hashes in the table, which has room for them"""
+        table = self.table
+        mask = len(table) - 1
+        size = self.size
+        for id_hash in hashes:
+            slot = id_hash & mask
+            while True:
+                entry = table[slot]
+                if not entry:
+                    table[slot] = id_hash
+                    size += 1
+                    break
+                if entry == id_hash:
+                    break
+                slot = (slot + 1) & mask
+        self.size = size
+
+    def add_hashes(self, hashes):
+        """Adds non-zero hashes, first making room for them all as if
+        none were in the table already so it stays at most half full"""
+        if (self.size + len(hashes)) * 2 > len(self.table):
+            self.resize((self.size + len(hashes)) * 2)
+        self.insert(hashes)
+
+    def flush(self):
+        if self.pending:
+            hashes, self.pending = self.pending, array('l')
+            self.add_hashes(hashes)
+
+    def update(self, other):
+        self.pending.extend(other.pending)
+        if other.size:
+            self.pending.extend([id_hash for id_hash in other.table if id_hash])
+        if len(self.pending) > len(self.table) // 2:
+            self.flush()
+
+    def __len__(self):
+        self.flush()
+        return self.size
+
+    def memory_size(self):
+        return (len(self.table) + len(self.pending)) * self.table.itemsize
+
+    def __repr__(self):
+        return 'IdHashSet(%d ids)' % len(self)
+
+# every node a file can be for has a fixed count slot
+count_slots = sorted(potential_names.keys())
+slot_index = dict((node, slot) for slot, node in enumerate(count_slots))
+rolled_up_into = dict((node, [sum_key for sum_key, sum_val
+                              in sum_columns.iteritems()
+                              if node in sum_val])
+                      for node in count_slots)
+
+class OrgAggregate(object):
+    """Everything the matrices need about one organization, updated in
+    place as file summaries arrive: the row count of the last file of
+    each node, the sum_columns totals, the validated flag, the fields
+    naming the project, the secondary matrix values per node and, when
+    counted, the distinct ids per node"""
+    __slots__ = ['counts', 'sums', 'validated', 'project', 'values', 'ids']
+
+    def __init__(self):
+        self.counts = array('l', [0] * len(count_slots))
+        self.sums = dict((sum_key, 0) for sum_key in sum_columns)
+        self.validated = False
+        self.project = None
+        self.values = {}
+        self.ids = {}
+
+    def add_file(self, node, summary):
+        """Records the summary of a file for node, replacing any
+        earlier file for it. Returns True if that replaced rows"""
+        slot = slot_index[node]
+        replaced = self.counts[slot]
+        self.counts[slot] = summary['rows']
+        for sum_key in rolled_up_into[node]:
+            self.sums[sum_key] += summary['rows'] - replaced
+        if node == 'project':
+            self.project = summary.get('first_row')
+        if summary['values']:
+            self.values[node] = summary['values']
+        else:
+            self.values.pop(node, None)
+        if 'ids' in summary:
+            self.ids[node] = summary['ids']
+        else:
+            self.ids.pop(node, None)
+
+        return replaced > 0
+
+    def count(self, column):
+        """Rows for a column, including any nodes rolled up into it"""
+        return self.counts[slot_index[column]] + self.sums.get(column, 0)
+
+    def memory_size(self):
+        """Rough bytes held, for the memory budget"""
+        size = sys.getsizeof(self.counts) + sys.getsizeof(self.sums)
+        for node_values in self.values.itervalues():
+            for values in node_values.itervalues():
+                size += values.memory_size()
+        for id_set in self.ids.itervalues():
+            size += id_set.memory_size()
+        return size
+
+    def unique_count(self, column):
+        """Distinct ids for a column, including any nodes rolled up
+        into it, or None if they weren't counted"""
+        id_sets = [self.ids[node] for node in [column] + sum_columns.get(column, [])
+                   if node in self.ids]
+        if not id_sets:
+            return None
+        if len(id_sets) == 1:
+            return len(id_sets[0])
+        merged = IdHashSet()
+        for id_set in id_sets:
+            merged.update(id_set)
+        return len(merged)
+
+class SpilledAggregates(object):
+    """The OrgAggregate of each organization, read and stored like a
+    dict. The aggregates stored last are kept in memory while their
+    estimated size is within budget bytes, older ones are pickled to
+    a temporary directory until close is called. Looking up a spilled
+    aggregate reads it back without keeping it, so the matrices are
+    rendered an organization at a time, and a changed aggregate has to
+    be stored again for the change to be kept. What reserved, such as
+    the result cache, says it holds counts against the budget too"""
+
+    def __init__(self, budget, directory=None, reserved=None):
+        self.budget = budget
+        self.reserved = reserved
+        # least recently stored first
+        self.resident = OrderedDict()
+        self.sizes = {}
+        self.spilled = {}
+        self.directory = tempfile.mkdtemp(prefix='matrix_spill_', dir=directory)
+        self.spill_count = 0
+
+    def __contains__(self, org_name):
+        return org_name in self.resident or org_name in self.spilled
+
+    def __len__(self):
+        return len(self.resident) + len(self.spilled)
+
+    def keys(self):
+        return self.resident.keys() + self.spilled.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        for org_name in self.keys():
+            yield org_name, self[org_name]
+
+    def __getitem__(self, org_name):
+        if org_name in self.resident:
+            return self.resident[org_name]
+        with open(self.spilled[org_name], 'rb') as in_file:
+            return cPickle.load(in_file)
+
+    def __setitem__(self, org_name, aggregate):
+        if org_name in self.spilled:
+            os.remove(self.spilled.pop(org_name))
+        self.resident.pop(org_name, None)
+        self.resident[org_name] = aggregate
+        self.sizes[org_name] = aggregate.memory_size()
+        total = sum(self.sizes.itervalues())
+        if self.reserved is not None:
+            total += self.reserved.memory_size()
+        while total > self.budget and len(self.resident) > 1:
+            total -= self.spill()
+
+    def spill(self):
+        """Pickles the least recently stored aggregate, returning the
+        bytes it was estimated to take"""
+        org_name, aggregate = self.resident.popitem(last=False)
+        file_name = os.path.join(self.directory, '%d.pickle' % self.spill_count)
+        self.spill_count += 1
+        with open(file_name, 'wb') as out_file:
+            cPickle.dump(aggregate, out_file, cPickle.HIGHEST_PROTOCOL)
+        self.spilled[org_name] = file_name
+        return self.sizes.pop(org_name)
+
+    def close(self):
+        """Removes the spilled aggregates, only those in memory remain"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.spilled = {}
+
+def close_aggregates(all_org_data):
+    """Removes anything the aggregates spilled to disk"""
+    if isinstance(all_org_data, SpilledAggregates):
+        all_org_data.close()
+
+def new_aggregates(memory_budget=None, spill_dir=None, reserved=None):
+    """Where the aggregate of each organization is kept, a dict unless
+    there is a budget in megabytes to keep them within"""
+    if memory_budget is None:
+        return {}
+    return SpilledAggregates(memory_budget * 1024 * 1024, spill_dir, reserved)
+
+def build_alias_index(names):
+    """Maps every node name and each of its aliases to the node name,
+    refusing names claimed by more than one node"""
+    alias_index = {}
+    for node, aliases in names.iteritems():
+        for name in [node] + aliases:
+            if alias_index.get(name, node) != node:
+                raise ValueError('%s is listed for both %s and %s' %
+                                 (name, alias_index[name], node))
+            alias_index[name] = node
+
+    return alias_index
+
+node_name_index = build_alias_index(potential_names)
+
+# node names already worked out, by file name
+node_name_cache = {}
+
 def normalize_node_name(key_name):
    
-    node_name = None
     # get node name from key name
-    file_name = key_name.split('/')[-1]
+    file_name = key_name.rpartition('/')[2]
+    if file_name in node_name_cache:
+        return node_name_cache[file_name]
+
+    key_file_name = file_name
+    # a compressed file is named for what it holds, cases.tsv.gz
+    file_name = strip_compression(file_name)
     if file_name.count('.') > 1:
         file_name = '.'.join(file_name.split('.')[1:])
 
@@ -321,22 +1384,21 @@ def normalize_node_name(key_name):
         potential_node_name = '_'.join(potential_node_name.split('_')[:-1])
     #print potential_node_name
 
-    # find node if in our table
-    if potential_node_name in potential_names.keys():
-        node_name = potential_node_name
-    # if not, let's try and see if it's
-    # something we know about
-    else:
-        for node in potential_names.keys():
-            if potential_node_name in potential_names[node]:
-                node_name = node
+    # find node if in our table, either by
+    # name or as something we know about
+    node_name = node_name_index.get(potential_node_name)
+    node_name_cache[key_file_name] = node_name
 
     return node_name
 
 def parse_org_project(value):
     data = {}
-    project = value['project'][0]
+    project = value.project
     #print project
+    if project is None:
+        # its project file was skipped or never listed
+        return {'project': 'unknown',
+                'description': 'unknown'}
     delimeters = ['_', '-']
     delimeter = None
     for delim in delimeters:
@@ -406,7 +1468,12 @@ def output_detailed_matrix_table(data, file_name):
                     if val2:
                         if ((header_val != 'project') and 
                             (header_val != 'description')):
-                            if len(val2) > 1:
+                            if getattr(val2, 'approximate', False):
+                                # too many to list, show how many with a sample
+                                out_file.write('<td><a class="tooltip" href="#">{} distinct (approx.)'
+                                               '<span class="classic">e.g. {}</span></a></td>'.format(
+                                                   len(val2), ', '.join(sorted(val2))))
+                            elif len(val2) > 1:
                                 count = 0
                                 values = ''
                                 for val in sorted(val2):
@@ -465,6 +1532,7 @@ def output_main_matrix_table(data, file_name):
         out_file.write('<table style = "width:100%">\n')
         header_order = None
         totals = defaultdict(int)
+        unique_totals = defaultdict(int)
         for key in sorted(data.keys()):
             value = data[key]
             if not header_order:
@@ -479,22 +1547,25 @@ def output_main_matrix_table(data, file_name):
             org_data = parse_org_project(data[key])
             out_file.write('<th>%s</th>' % ' '.join(key.replace('_', ' ').split()[1:2]))
             for header_val in header_order:
-                if header_val in data[key].keys():
-                    val2 = data[key][header_val]
-                    if header_val == validated_key:
-                        out_file.write('<td>%r</td>' % val2)
-                        if val2:
-                            totals[header_val] += 1
-                    else:
-                        if val2:
-                            if header_val != 'project':
-                                out_file.write('<td>%d</td>' % len(val2))
-                            else:
-                                out_file.write('<td>%s</td>' % org_data['project'])
-                                
-                            totals[header_val] += len(val2)
+                if header_val == validated_key:
+                    out_file.write('<td>%r</td>' % value.validated)
+                    if value.validated:
+                        totals[header_val] += 1
+                elif header_val in slot_index:
+                    val2 = value.count(header_val)
+                    if val2:
+                        unique = value.unique_count(header_val)
+                        if header_val != 'project' and unique is not None:
+                            out_file.write('<td>%d (%d unique)</td>' % (val2, unique))
+                            unique_totals[header_val] += unique
+                        elif header_val != 'project':
+                            out_file.write('<td>%d</td>' % val2)
                         else:
-                            out_file.write('<td>--</td>' )
+                            out_file.write('<td>%s</td>' % org_data['project'])
+                            
+                        totals[header_val] += val2
+                    else:
+                        out_file.write('<td>--</td>' )
                 else:
                     #print "%s not in data" % header_val
                     #print data.keys()
@@ -529,7 +1600,11 @@ def output_main_matrix_table(data, file_name):
                     val = totals[header_val]
                 else:
                     val = 0
-                out_file.write('<td>%d</td>' % val)
+                if header_val in unique_totals:
+                    out_file.write('<td>%d (%d unique)</td>' %
+                                   (val, unique_totals[header_val]))
+                else:
+                    out_file.write('<td>%d</td>' % val)
         out_file.write('</tfoot>\n')
 
         out_file.write('</table></section></div></div></div>\n')
@@ -538,79 +1613,21 @@ def output_main_matrix_table(data, file_name):
         out_file.write('</body></html>\n')
 
 
-def sum_parsed_data(data):
-    new_dict = {}
-    for key, value in data.iteritems():
-        #print '\n***Processing {}'.format(key)
-        new_dict[key] = {}
-        for key2, val2 in value.iteritems():
-            if key2 != validated_key:
-                #print 'loading {} of {}'.format(len(value[key2]), key2)
-                if key2 in new_dict[key]:
-                    new_val = list(new_dict[key][key2])
-                else:
-                    new_val = list(value[key2])
-                for sum_key, sum_val in sum_columns.iteritems():
-                    if key2 in sum_val:
-                        if len(val2):
-                            #print 'extending %s by %d' % (sum_key, len(val2))
-                            new_dict[key][sum_key] = list(val2)
-                new_dict[key][key2] = list(new_val)
-                #print '%s %s now %d' % (key, key2, len(new_val))
-            else:
-                new_dict[key][key2] = bool(val2)
-
-        #for key2 in new_dict[key].keys():
-        #    if type(new_dict[key][key2]) != bool:
-        #        print "{}: {}".format(key2, len(new_dict[key][key2]))
-
-    return new_dict
-
-
-
 def process_parsed_data(data):
     new_dict = {}
     for key, value in data.iteritems():
-        data = {}
-        project = value['project'][0]
-        print project
-        delimeters = ['_', '-']
-        delimeter = None
-        for delim in delimeters:
-            if delim in project['submitter_id']:
-                delimeter = delim
-                break
-        
-        if delimeter:
-            project_parts = project['submitter_id'].split(delimeter)
-        else:
-            print 'Unable to guess delimeter for {}'.format(project['submitter_id'])
-        #data['organization'] = project_parts[1]
-        project_name = None
-        if len(project_parts) > 2:
-            for part in project_parts:
-                if part.startswith('P'):
-                    project_name = part
-        
-        if project_name:
-            data['project'] = project_name
-        else:
-            print 'Unable to determine project for {}'.format(project['submitter_id'])
-            data['project'] = 'p0001'
-
-        if 'name' in project:
-            data['description'] = project['name']
-        else:
-            data['description'] = 'unknown'
+        print value.project
+        data = parse_org_project(value)
+        data.pop('organization', None)
 
         for mat_key, mat_val in matrix_table_lookup.iteritems():
-            for entry in value[mat_key]:
-                for entry2 in mat_val:
-                    if entry2 in entry:
-                        if json_to_logical_value[entry2] not in data:
-                            data[json_to_logical_value[entry2]] = set([entry[entry2]])
-                        else:
-                            data[json_to_logical_value[entry2]].add(entry[entry2])
+            values = value.values.get(mat_key, {})
+            for entry2 in mat_val:
+                if entry2 in values:
+                    if json_to_logical_value[entry2] not in data:
+                        data[json_to_logical_value[entry2]] = DistinctValues(values[entry2])
+                    else:
+                        data[json_to_logical_value[entry2]].update(values[entry2])
         new_dict[key] = data
 
     for key, value in new_dict.iteritems():
@@ -620,88 +1637,1550 @@ def process_parsed_data(data):
         print
     return new_dict
 
-
-def print_dict(cur_dict):
-    for key, value in cur_dict.iteritems():
-        print key
-        for key2, val2 in value.iteritems():
-            if val2:
-                if type(val2) == list:
-                    print "\t%s: %d" % (key2, len(val2))
+def build_snapshot(data, detailed=None):
+    """The counts and totals of the main matrix, and the distinct values
+    of the detailed matrix if given, in a form that saves as JSON"""
+    organizations = {}
+    totals = defaultdict(int)
+    unique_totals = defaultdict(int)
+    for key in sorted(data.keys()):
+        value = data[key]
+        org_data = parse_org_project(value)
+        counts = {}
+        unique_counts = {}
+        for header_val in main_header_order:
+            if header_val == validated_key:
+                if value.validated:
+                    totals[header_val] += 1
+            elif header_val in slot_index:
+                counts[header_val] = value.count(header_val)
+                totals[header_val] += counts[header_val]
+                unique = value.unique_count(header_val)
+                if unique is not None and header_val != 'project':
+                    unique_counts[header_val] = unique
+                    unique_totals[header_val] += unique
+        organizations[key] = {
+            'name': ' '.join(key.replace('_', ' ').split()[1:2]),
+            'project': org_data.get('project'),
+            'description': org_data.get('description'),
+            'validated': value.validated,
+            'counts': counts
+        }
+        # only with --unique_ids, for the columns that have the ids
+        if unique_counts:
+            organizations[key]['unique_counts'] = unique_counts
+        if detailed is not None:
+            org_values = dict((column, values) for column, values
+                              in detailed.get(key, {}).iteritems()
+                              if column not in ['project', 'description'])
+            organizations[key]['values'] = dict(
+                (column, sorted(column_values.decode('utf-8', 'replace')
+                                for column_values in values))
+                for column, values in org_values.iteritems())
+            # columns with too many values to keep only have a sample
+            # of them, and an estimate of how many there are
+            organizations[key]['approximate_distinct'] = dict(
+                (column, len(values)) for column, values in org_values.iteritems()
+                if getattr(values, 'approximate', False))
+
+    snapshot = {'version': snapshot_version,
+                'generated': datetime.datetime.utcnow().isoformat(),
+                'columns': [header_val for header_val in main_header_order
+                            if header_val not in no_total_columns],
+                'value_columns': [header_val for header_val in secondary_header_order
+                                  if header_val not in ['organization', 'project',
+                                                        'description']],
+                'organizations': organizations,
+                'totals': dict((header_val, totals[header_val])
+                               for header_val in main_header_order
+                               if header_val not in no_total_columns),
+                'formats_not_supported': dict(hardcoded_orgs)}
+    if unique_totals:
+        snapshot['unique_totals'] = dict(unique_totals)
+
+    return snapshot
+
+def write_snapshot_json(snapshot, file_name):
+    # consumers may fetch the file at any time
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'w') as out_file:
+        json.dump(snapshot, out_file, indent=2, sort_keys=True)
+    os.rename(temp_name, file_name)
+
+def write_snapshot_csv(snapshot, file_name):
+    """One row per organization, with the counts, whether it is
+    validated and the distinct values joined by semicolons, then
+    a row of totals"""
+    count_columns = [column for column in snapshot['columns']
+                     if column not in ['project', validated_key]]
+    unique_columns = [column for column in count_columns
+                      if column in snapshot.get('unique_totals', {})]
+    value_columns = snapshot['value_columns']
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'wb') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(['Organization', 'Project', 'Project Description'] +
+                        [header_strings[column] for column in count_columns] +
+                        ['%s Unique' % header_strings[column] for column in unique_columns] +
+                        ['Validated'] +
+                        [secondary_header_strings[column] for column in value_columns])
+        for key, org in sorted(snapshot['organizations'].iteritems()):
+            values = org.get('values', {})
+            writer.writerow([org['name'], org['project'], org['description']] +
+                            [org['counts'][column] for column in count_columns] +
+                            [org.get('unique_counts', {}).get(column, '')
+                             for column in unique_columns] +
+                            [org['validated']] +
+                            [';'.join(values.get(column, [])).encode('utf-8')
+                             for column in value_columns])
+        writer.writerow(['TOTALS', '', ''] +
+                        [snapshot['totals'][column] for column in count_columns] +
+                        [snapshot['unique_totals'][column] for column in unique_columns] +
+                        [snapshot['totals'][validated_key]] +
+                        [''] * len(value_columns))
+    os.rename(temp_name, file_name)
+
+
+class StorageBackend(object):
+    """Where the bucket is read from. Listings are lists of dicts with
+    key_name, size, etag and last_modified, in key order"""
+
+    def list(self, prefix=''):
+        raise NotImplementedError
+
+    def list_top_level(self):
+        """The top level prefixes of the bucket, such as 'org/', and
+        the listing of the keys outside of them, or None if the bucket
+        can't be listed a prefix at a time"""
+        return None
+
+    def stat(self, key_name):
+        raise NotImplementedError
+
+    def open(self, key_name):
+        """Returns a file like object to read the object from"""
+        raise NotImplementedError
+
+    def read(self, key_name):
+        handle = self.open(key_name)
+        try:
+            return handle.read()
+        finally:
+            handle.close()
+
+class S3Backend(StorageBackend):
+    """Reads the bucket through occlibs' S3_Wrapper, with one
+    connection to the object store for each thread using it"""
+
+    def __init__(self, s3_inst, object_store, bucket_name):
+        self.s3_inst = s3_inst
+        self.object_store = object_store
+        self.bucket_name = bucket_name
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.s3_inst.connect_to_s3(self.object_store)
+        return self.local.conn
+
+    def bucket(self):
+        # the boto bucket behind the connection, if we can get at it
+        conn = self.connection()
+        if hasattr(conn, 'get_bucket'):
+            return conn.get_bucket(self.bucket_name, validate=False)
+        return None
+
+    def list(self, prefix=''):
+        bucket = self.bucket()
+        if not prefix or not hasattr(bucket, 'list'):
+            files = self.s3_inst.get_files_in_s3_bucket(self.connection(),
+                                                        self.bucket_name)
+            return [entry for entry in files
+                    if entry['key_name'].startswith(prefix)]
+        return [self.key_entry(key) for key in bucket.list(prefix=prefix)]
+
+    def list_top_level(self):
+        bucket = self.bucket()
+        if not hasattr(bucket, 'list'):
+            return None
+        prefixes = []
+        files = []
+        for item in bucket.list(delimiter='/'):
+            # boto gives a Prefix for each common prefix, without an etag
+            if hasattr(item, 'etag'):
+                files.append(self.key_entry(item))
+            else:
+                prefixes.append(item.name)
+        return sorted(prefixes), files
+
+    def key_entry(self, key):
+        return {'key_name': key.name,
+                'size': key.size,
+                'etag': key.etag,
+                'last_modified': key.last_modified}
+
+    def stat(self, key_name):
+        bucket = self.bucket()
+        if bucket is None:
+            for entry in self.list():
+                if entry['key_name'] == key_name:
+                    return entry
+            return None
+        key = bucket.get_key(key_name)
+        if key is None:
+            return None
+        return {'key_name': key_name,
+                'size': key.size,
+                'etag': key.etag,
+                'last_modified': key.last_modified}
+
+    def open(self, key_name):
+        bucket = self.bucket()
+        if bucket is None:
+            return StringIO(self.read(key_name))
+        return bucket.get_key(key_name)
+
+    def read(self, key_name):
+        return self.s3_inst.load_file(conn=self.connection(),
+                                      bucket_name=self.bucket_name,
+                                      key_name=key_name)
+
+class LocalBackend(StorageBackend):
+    """Reads a local mirror of the bucket, where each key is a path
+    under root. Objects are memory mapped rather than read in"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key_name):
+        return os.path.join(self.root, *key_name.split('/'))
+
+    def list(self, prefix=''):
+        key_names = []
+        # walk no more of the tree than the prefix covers
+        top = os.path.dirname(self.path(prefix)) if prefix else self.root
+        for dir_path, dir_names, file_names in os.walk(top):
+            for file_name in file_names:
+                path = os.path.relpath(os.path.join(dir_path, file_name),
+                                       self.root)
+                key_name = path.replace(os.sep, '/')
+                if key_name.startswith(prefix):
+                    key_names.append(key_name)
+        return [self.stat(key_name) for key_name in sorted(key_names)]
+
+    def list_top_level(self):
+        prefixes = []
+        files = []
+        for name in sorted(os.listdir(self.root)):
+            if os.path.isdir(os.path.join(self.root, name)):
+                prefixes.append(name + '/')
+            else:
+                files.append(self.stat(name))
+        return prefixes, files
+
+    def stat(self, key_name):
+        try:
+            stat = os.stat(self.path(key_name))
+        except OSError:
+            return None
+        return {'key_name': key_name,
+                'size': stat.st_size,
+                'etag': None,
+                'last_modified': stat.st_mtime}
+
+    def open(self, key_name):
+        with open(self.path(key_name), 'rb') as in_file:
+            # empty files can't be mapped
+            if not os.fstat(in_file.fileno()).st_size:
+                return StringIO('')
+            return mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, key_name):
+        with open(self.path(key_name), 'rb') as in_file:
+            return in_file.read()
+
+def add_summary(merged, summary):
+    """Adds the counts and values of a block summary to the running
+    summary of its file, leaving first_row to the caller"""
+    merged['rows'] += summary['rows']
+    for column, values in summary['values'].iteritems():
+        merged['values'].setdefault(column, DistinctValues()).update(values)
+    if 'ids' in summary:
+        merged.setdefault('ids', IdHashSet()).update(summary['ids'])
+    merged['skipped'] += summary.get('skipped', 0)
+
+def wanted_columns(node_data_type, collect_values, unique_ids=False):
+    """Secondary matrix fields to collect from a file of this node,
+    and the id column if its distinct values are counted"""
+    columns = []
+    if collect_values:
+        columns = list(matrix_table_lookup.get(node_data_type, []))
+    if unique_ids and node_data_type != 'project':
+        columns.append(id_column)
+    return columns
+
+def summarize_data(node_data_type, data, columns, data_type=file_type,
+                   text_format=None):
+    """Summarizes the body of a file, or a block of it, given as a
+    string or a list of chunks, in the text_format of the file if
+    known. Rows are only counted unless there are columns to collect,
+    except for project files which are always parsed since they name
+    the organization"""
+    stats = {}
+    if isinstance(data, basestring):
+        data = [data]
+    data = decompress_chunks(data)
+    if not columns and node_data_type != 'project' and data_type != 'json':
+        summary = count_summary(count_data_rows(data, data_type,
+                                                stats=stats,
+                                                text_format=text_format))
+    elif node_data_type == 'project':
+        rows = parse_data_file(data, data_type,
+                               columns=project_fields + list(columns),
+                               stats=stats,
+                               text_format=text_format)
+        summary = summarize_rows(node_data_type, rows, columns)
+    else:
+        rows, values = parse_data_file(data, data_type,
+                                       columns=columns,
+                                       distinct=True,
+                                       stats=stats,
+                                       text_format=text_format)
+        summary = count_summary(rows, columns, values)
+    summary['skipped'] = stats['skipped']
+
+    return summary
+
+def object_version(entry):
+    """What identifies the contents of a listed object, if anything"""
+    etag = entry.get('etag')
+    last_modified = entry.get('last_modified')
+    if not etag and not last_modified:
+        return None
+    return (etag, last_modified, entry.get('size'))
+
+class ResultCache(object):
+    """Summaries of previously processed objects, kept on disk and
+    keyed on the object key. An entry is only used while the ETag and
+    modification time in the listing still match, and entries for keys
+    that are no longer listed are dropped on save. Summaries are kept
+    pickled, so what is handed out shares nothing with the cache and
+    is let go of along with the aggregate it goes into"""
+
+    def __init__(self, file_name, rebuild=False):
+        self.file_name = file_name
+        self.entries = {}
+        self.seen = set()
+        if not rebuild and os.path.exists(file_name):
+            try:
+                with open(file_name, 'rb') as cache_file:
+                    cached = cPickle.load(cache_file)
+                if not isinstance(cached, dict) or \
+                        cached.get('version') != cache_version:
+                    print "Cache %s is from another version, rebuilding" % file_name
                 else:
-                    print "\t%s: %r" % (key2, val2)
-                #print val2
-
-
-
-s3_inst = S3_Wrapper()
-args = parse_cmd_args(s3_inst)
-
-object_store = os.environ['S3_OBJECT_STORE']
-bucket_name = os.environ['S3_BUCKET']
-
-s3_conn = s3_inst.connect_to_s3(object_store)
-files = s3_inst.get_files_in_s3_bucket(s3_conn, bucket_name)
-
-
-
-default_data = {}
-for val in potential_names.keys():
-    default_data[val] = []
-default_data[validated_key] = False
-
-total_size = 0
-all_org_data = {}
-for entry in files:
-    # check if it's a tsv file
-    if file_type in entry['key_name']:
-        # check if it's a tsv file we care about
+                    self.entries = cached['entries']
+            except Exception as e:
+                print "Unable to read cache %s (%s), rebuilding" % (file_name, e)
+                self.entries = {}
+        self.size = sum(len(data) for cached_version, columns, data
+                        in self.entries.itervalues())
+
+    def get(self, key_name, version, columns):
+        self.seen.add(key_name)
+        if not version or key_name not in self.entries:
+            return None
+        cached_version, cached_columns, data = self.entries[key_name]
+        if cached_version != version:
+            return None
+        if not set(columns) <= set(cached_columns):
+            return None
+        return cPickle.loads(data)
+
+    def put(self, key_name, version, summary):
+        if version:
+            if key_name in self.entries:
+                self.size -= len(self.entries[key_name][2])
+            data = cPickle.dumps(summary, cPickle.HIGHEST_PROTOCOL)
+            self.entries[key_name] = (version, summary['columns'], data)
+            self.size += len(data)
+
+    def memory_size(self):
+        """Bytes of the pickled summaries held, for the memory budget"""
+        return self.size
+
+    def save(self, wanted=None):
+        """Writes the cache out. wanted tells, by its organization,
+        whether a key was meant to be listed this run; keys of
+        organizations left out of the listing are kept for later runs"""
+        for key_name in set(self.entries) - self.seen:
+            if wanted is None or wanted(key_name.split('/')[0]):
+                self.size -= len(self.entries.pop(key_name)[2])
+        temp_name = self.file_name + '.tmp'
+        with open(temp_name, 'wb') as cache_file:
+            cPickle.dump({'version': cache_version,
+                          'entries': self.entries},
+                         cache_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_name, self.file_name)
+
+class RunMetrics(object):
+    """Wall time of each phase of a run and what happened to each
+    object, written out as JSON and for node_exporter's textfile
+    collector. Objects may be recorded from any fetch thread"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def record_object(self, key_name, **fields):
+        with self.lock:
+            self.objects.setdefault(key_name, {'key_name': key_name}).update(fields)
+
+    def report(self, slowest=default_slowest_objects):
+        totals = defaultdict(int)
+        orgs = {}
+        for entry in self.objects.itervalues():
+            org = orgs.setdefault(entry.get('org'), defaultdict(int))
+            org['objects'] += 1
+            totals['objects'] += 1
+            if entry.get('cached'):
+                org['cached_objects'] += 1
+                totals['cached_objects'] += 1
+            if entry.get('error'):
+                org['failed'] += 1
+                totals['failed'] += 1
+            for field in ['bytes', 'rows', 'skipped', 'retries', 'hedged']:
+                org[field] += entry.get(field, 0)
+                totals[field] += entry.get(field, 0)
+            for field in ['fetch_seconds', 'parse_seconds']:
+                totals[field] += entry.get(field, 0)
+
+        fetched = [entry for entry in self.objects.itervalues()
+                   if 'seconds' in entry]
+        fetched.sort(key=lambda entry: entry['seconds'], reverse=True)
+        return {'started': datetime.datetime.utcfromtimestamp(self.started).isoformat(),
+                'seconds': time.time() - self.started,
+                'phases': dict(self.phases),
+                'totals': dict(totals),
+                'orgs': dict((org, dict(values)) for org, values in orgs.iteritems()),
+                'slowest_objects': fetched[:slowest],
+                'objects': sorted(self.objects.values(),
+                                  key=lambda entry: entry['key_name'])}
+
+    def write_json(self, file_name, slowest=default_slowest_objects):
+        with open(file_name, 'w') as out_file:
+            json.dump(self.report(slowest), out_file, indent=2, sort_keys=True)
+
+    def write_prometheus(self, file_name):
+        report = self.report(0)
+        lines = []
+        def metric(name, help_text, samples):
+            lines.append('# HELP bpa_matrix_%s %s' % (name, help_text))
+            lines.append('# TYPE bpa_matrix_%s gauge' % name)
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (label, str(label_value).replace('"', '\\"'))
+                                      for label, label_value in labels)
+                if label_text:
+                    label_text = '{%s}' % label_text
+                lines.append('bpa_matrix_%s%s %r' % (name, label_text, float(value)))
+
+        metric('last_run_timestamp_seconds', 'When the last run started',
+               [((), self.started)])
+        metric('run_seconds', 'Wall time of the last run',
+               [((), report['seconds'])])
+        metric('phase_seconds', 'Wall time of each phase of the last run',
+               [((('phase', phase),), seconds)
+                for phase, seconds in sorted(report['phases'].iteritems())])
+        for field, help_text in [('objects', 'Objects processed'),
+                                 ('cached_objects', 'Objects served from the cache'),
+                                 ('bytes', 'Bytes fetched'),
+                                 ('rows', 'Data rows parsed'),
+                                 ('skipped', 'Lines skipped while parsing'),
+                                 ('failed', 'Objects skipped after failing every attempt'),
+                                 ('retries', 'Object fetches retried'),
+                                 ('hedged', 'Objects a second request was raised for'),
+                                 ('fetch_seconds', 'Time spent fetching, summed over objects'),
+                                 ('parse_seconds', 'Time spent parsing, summed over objects')]:
+            metric(field, help_text + ' in the last run',
+                   [((), report['totals'].get(field, 0))])
+        for field, help_text in [('org_objects', 'Objects per organization'),
+                                 ('org_rows', 'Data rows per organization'),
+                                 ('org_bytes', 'Bytes fetched per organization')]:
+            metric(field, help_text + ' in the last run',
+                   [((('org', org),), values.get(field[4:], 0))
+                    for org, values in sorted(report['orgs'].iteritems())
+                    if org is not None])
+
+        # node_exporter may read the file at any time
+        temp_name = file_name + '.tmp'
+        with open(temp_name, 'w') as out_file:
+            out_file.write('\n'.join(lines) + '\n')
+        os.rename(temp_name, file_name)
+
+    def print_summary(self, slowest=default_slowest_objects):
+        report = self.report(slowest)
+        for phase, seconds in sorted(report['phases'].iteritems()):
+            print '%s: %.2fs' % (phase, seconds)
+        print 'Slowest objects:'
+        for entry in report['slowest_objects']:
+            print '\t%s: %.2fs, %d bytes, %d rows' % (entry['key_name'],
+                                                       entry['seconds'],
+                                                       entry.get('bytes', 0),
+                                                       entry.get('rows', 0))
+        failed = [entry for entry in report['objects'] if entry.get('error')]
+        if failed:
+            print '%d objects skipped after failing every attempt:' % len(failed)
+            for entry in failed:
+                print '\t%s: %s' % (entry['key_name'], entry['error'])
+
+class RunHistory(object):
+    """Counts, validation flags and object versions of every run, kept
+    in a SQLite database so trends can be queried later. Old runs are
+    thinned and dropped by compact"""
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS runs ('
+        '    id INTEGER PRIMARY KEY,'
+        '    generated TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS runs_generated ON runs (generated)',
+        'CREATE TABLE IF NOT EXISTS orgs ('
+        '    run_id INTEGER NOT NULL,'
+        '    org TEXT NOT NULL,'
+        '    name TEXT,'
+        '    project TEXT,'
+        '    validated INTEGER NOT NULL,'
+        '    PRIMARY KEY (run_id, org))',
+        'CREATE TABLE IF NOT EXISTS counts ('
+        '    run_id INTEGER NOT NULL,'
+        '    org TEXT NOT NULL,'
+        '    column_name TEXT NOT NULL,'
+        '    count INTEGER NOT NULL,'
+        '    PRIMARY KEY (run_id, org, column_name))',
+        'CREATE INDEX IF NOT EXISTS counts_series ON counts (org, column_name, run_id)',
+        'CREATE TABLE IF NOT EXISTS files ('
+        '    run_id INTEGER NOT NULL,'
+        '    key_name TEXT NOT NULL,'
+        '    etag TEXT,'
+        '    size INTEGER,'
+        '    last_modified TEXT,'
+        '    PRIMARY KEY (run_id, key_name))',
+    ]
+
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name)
+        self.connection.text_factory = str
+        with self.connection:
+            for statement in self.schema:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, snapshot, files):
+        """Adds a run from its snapshot and the listed data files,
+        returning the id of the run"""
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (generated) VALUES (?)',
+                (snapshot['generated'],))
+            run_id = cursor.lastrowid
+            for org, values in snapshot['organizations'].iteritems():
+                self.connection.execute(
+                    'INSERT INTO orgs VALUES (?, ?, ?, ?, ?)',
+                    (run_id, org, values['name'], values['project'],
+                     int(bool(values['validated']))))
+                self.connection.executemany(
+                    'INSERT INTO counts VALUES (?, ?, ?, ?)',
+                    [(run_id, org, column, count)
+                     for column, count in values['counts'].iteritems()])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                [(run_id, entry['key_name'], entry.get('etag'),
+                  entry.get('size'),
+                  None if entry.get('last_modified') is None
+                  else str(entry['last_modified']))
+                 for entry in files])
+        return run_id
+
+    def compact(self, keep_days=default_history_keep_days,
+                daily_after_days=default_history_daily_after_days):
+        """Drops runs older than keep_days, and all but the last run of
+        each day for runs older than daily_after_days"""
+        now = datetime.datetime.utcnow()
+        oldest = (now - datetime.timedelta(days=keep_days)).isoformat()
+        daily = (now - datetime.timedelta(days=daily_after_days)).isoformat()
+        with self.connection:
+            old_runs = [row[0] for row in self.connection.execute(
+                'SELECT id FROM runs WHERE generated < ? OR '
+                '(generated < ? AND id NOT IN '
+                ' (SELECT MAX(id) FROM runs GROUP BY substr(generated, 1, 10)))',
+                (oldest, daily))]
+            for table in ['orgs', 'counts', 'files']:
+                self.connection.executemany(
+                    'DELETE FROM %s WHERE run_id = ?' % table,
+                    [(run_id,) for run_id in old_runs])
+            self.connection.executemany('DELETE FROM runs WHERE id = ?',
+                                        [(run_id,) for run_id in old_runs])
+        if old_runs:
+            self.connection.execute('VACUUM')
+        return len(old_runs)
+
+    def runs(self, limit=None):
+        """(id, generated) of the most recent runs, oldest first"""
+        rows = self.connection.execute(
+            'SELECT id, generated FROM runs ORDER BY id DESC LIMIT ?',
+            (-1 if limit is None else limit,)).fetchall()
+        return list(reversed(rows))
+
+    def series(self, org, column, since=None):
+        """(run id, generated, count) of one column of an organization,
+        which can be given by its bucket prefix or its matrix name"""
+        return self.connection.execute(
+            'SELECT runs.id, runs.generated, counts.count '
+            'FROM counts JOIN runs ON runs.id = counts.run_id '
+            'JOIN orgs ON orgs.run_id = counts.run_id AND orgs.org = counts.org '
+            'WHERE (counts.org = ? OR orgs.name = ?) AND counts.column_name = ? '
+            'AND runs.generated >= ? '
+            'ORDER BY runs.id',
+            (org, org, column, since or '')).fetchall()
+
+    def diff(self, old_run, new_run):
+        """Lines describing what changed from one run to another"""
+        changes = []
+        old_orgs, new_orgs = [dict((row[0], row[1:]) for row in self.connection.execute(
+                                  'SELECT org, validated FROM orgs WHERE run_id = ?',
+                                  (run_id,)))
+                              for run_id in [old_run, new_run]]
+        for org in sorted(set(old_orgs) - set(new_orgs)):
+            changes.append('%s: removed' % org)
+        for org in sorted(set(new_orgs) - set(old_orgs)):
+            changes.append('%s: added' % org)
+        for org in sorted(set(old_orgs) & set(new_orgs)):
+            if old_orgs[org] != new_orgs[org]:
+                changes.append('%s validated: %s -> %s' %
+                               (org, bool(old_orgs[org][0]), bool(new_orgs[org][0])))
+
+        old_counts, new_counts = [dict(((row[0], row[1]), row[2]) for row in self.connection.execute(
+                                      'SELECT org, column_name, count FROM counts WHERE run_id = ?',
+                                      (run_id,)))
+                                  for run_id in [old_run, new_run]]
+        for org, column in sorted(set(old_counts) | set(new_counts)):
+            old_count = old_counts.get((org, column), 0)
+            new_count = new_counts.get((org, column), 0)
+            if old_count != new_count:
+                changes.append('%s %s: %d -> %d (%+d)' % (org, column, old_count,
+                                                          new_count, new_count - old_count))
+
+        old_files, new_files = [dict((row[0], row[1:]) for row in self.connection.execute(
+                                    'SELECT key_name, etag, size FROM files WHERE run_id = ?',
+                                    (run_id,)))
+                                for run_id in [old_run, new_run]]
+        for key_name in sorted(set(old_files) | set(new_files)):
+            if key_name not in new_files:
+                changes.append('%s: deleted' % key_name)
+            elif key_name not in old_files:
+                changes.append('%s: new' % key_name)
+            elif old_files[key_name] != new_files[key_name]:
+                changes.append('%s: changed' % key_name)
+
+        return changes
+
+def history_command(argv):
+    """Runs the history command with the arguments after 'history'"""
+    args = parse_history_args(argv)
+    if not os.path.exists(args.history_db):
+        print "No history database at %s" % args.history_db
+        return 1
+    history = RunHistory(args.history_db)
+    try:
+        if args.command == 'runs':
+            for run_id, generated in history.runs(args.limit):
+                print '%d\t%s' % (run_id, generated)
+        elif args.command == 'series':
+            for run_id, generated, count in history.series(args.org, args.column,
+                                                           args.since):
+                print '%s\t%d' % (generated, count)
+        elif args.command == 'diff':
+            run_ids = [run_id for run_id, generated in history.runs()]
+            new_run = args.new_run or (run_ids and run_ids[-1])
+            old_run = args.old_run
+            if old_run is None:
+                earlier = [run_id for run_id in run_ids if run_id < new_run]
+                old_run = earlier and earlier[-1]
+            if not old_run or not new_run:
+                print "Need two runs to compare"
+                return 1
+            print 'Changes from run %d to run %d:' % (old_run, new_run)
+            for change in history.diff(old_run, new_run):
+                print '\t' + change
+    finally:
+        history.close()
+    return 0
+
+class PipelineStopped(Exception):
+    """Raised inside a pipeline stage once the run is being stopped"""
+
+class FetchTimeout(Exception):
+    """Raised when an object read has had no data for too long"""
+
+def put_item(queue, item, stop):
+    """Puts an item on a bounded queue, waiting for room unless the
+    pipeline is stopped in the meantime"""
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            queue.put(item, timeout=queue_poll_seconds)
+            return
+        except Queue.Full:
+            pass
+
+def get_item(queue, stop):
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            return queue.get(timeout=queue_poll_seconds)
+        except Queue.Empty:
+            pass
+
+def run_stage(stage, results, stop, *args):
+    """Runs the loop of one pipeline stage on its own thread, handing
+    any failure to the aggregate stage to raise"""
+    try:
+        stage(*args)
+    except PipelineStopped:
+        pass
+    except Exception:
+        try:
+            put_item(results, ('error', sys.exc_info()), stop)
+        except PipelineStopped:
+            pass
+
+class FetchPolicy(object):
+    """How objects are fetched: the seconds a read may go without data
+    before the attempt is given up on, the attempts after the first,
+    the seconds before the first retry, doubled for each one after,
+    and the percentile of first chunk latencies past which a second
+    request is raised for an object, if any. First chunk latencies are
+    recorded from every fetch thread"""
+
+    def __init__(self, timeout=default_fetch_timeout,
+                 retries=default_fetch_retries,
+                 backoff=default_retry_backoff,
+                 hedge_percentile=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.latencies = deque(maxlen=hedge_window)
+        self.lock = threading.Lock()
+
+    def record_first_chunk(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def hedge_after(self):
+        """Seconds to wait for a first chunk before raising a second
+        request, or None"""
+        if self.hedge_percentile is None:
+            return None
+        with self.lock:
+            if len(self.latencies) < min_hedge_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * self.hedge_percentile / 100.0))]
+
+    def retry_delay(self, attempt):
+        """Seconds to wait before retrying after a failed attempt, with
+        jitter so fetch threads failing together don't retry together"""
+        delay = min(max_retry_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+def read_object(handle, reader, chunks, stop):
+    """Puts the chunks of an open object on the chunks queue, tagged
+    with reader, then an empty one, or the failure if reading fails.
+    Gives up once stop is set, closing the object either way"""
+    try:
+        for chunk in read_chunks(handle):
+            put_item(chunks, (reader, chunk, None), stop)
+        put_item(chunks, (reader, '', None), stop)
+    except PipelineStopped:
+        pass
+    except Exception:
+        try:
+            put_item(chunks, (reader, None, sys.exc_info()), stop)
+        except PipelineStopped:
+            pass
+    finally:
+        handle.close()
+
+def fetch_chunks(backend, key_name, policy, stats, stop):
+    """Yields the chunks of an object, read on a thread of its own so
+    a stalled read can be left behind, raising FetchTimeout once there
+    is no data for policy.timeout seconds. The object is opened on the
+    calling thread, so it is read over that thread's connection rather
+    than one for each reading thread. When the first chunk takes
+    longer than policy.hedge_after, a second request is raised and
+    whichever answers first is read, the other is stopped. The bytes
+    read and the time spent waiting on them are added up in stats"""
+    chunks = Queue.Queue(2)
+    # each request is stopped on its own
+    readers = {}
+
+    def start_reader(reader):
+        handle = backend.open(key_name)
+        readers[reader] = threading.Event()
+        thread = threading.Thread(target=read_object,
+                                  args=(handle, reader, chunks,
+                                        readers[reader]))
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    hedge_after = policy.hedge_after()
+    winner = None
+    hedged = False
+    start_reader(0)
+    try:
+        waiting = time.time()
+        while True:
+            try:
+                reader, chunk, exc_info = chunks.get(timeout=queue_poll_seconds)
+            except Queue.Empty:
+                if stop.is_set():
+                    raise PipelineStopped()
+                waited = time.time() - waiting
+                if winner is None and hedge_after is not None and \
+                        not hedged and waited >= hedge_after:
+                    print "Raising a second request for %s after %.2fs" % (key_name, waited)
+                    stats['hedged'] = 1
+                    hedged = True
+                    try:
+                        start_reader(1)
+                    except Exception as e:
+                        # the first request may still come through
+                        print "Unable to raise a second request for %s, %s" % (key_name, e)
+                elif policy.timeout and waited >= policy.timeout:
+                    raise FetchTimeout('nothing read from %s for %.0f seconds' %
+                                       (key_name, waited))
+                continue
+            if winner is None:
+                if exc_info and len(readers) > 1:
+                    # the other request may still come through
+                    del readers[reader]
+                    continue
+                winner = reader
+                policy.record_first_chunk(time.time() - start)
+                for other, other_stop in readers.iteritems():
+                    if other != winner:
+                        other_stop.set()
+            elif reader != winner:
+                # what the stopped request read before it noticed
+                continue
+            stats['fetch_seconds'] += time.time() - waiting
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if not chunk:
+                return
+            stats['bytes'] += len(chunk)
+            yield chunk
+            waiting = time.time()
+    finally:
+        # the readers see this within queue_poll_seconds and close
+        # their objects, unless they are stuck reading them
+        for reader_stop in readers.itervalues():
+            reader_stop.set()
+
+def list_stage(files, collect_values, unique_ids, cache, metrics, tasks,
+               fetch_queue, results, stop):
+    """Works out which listed files we care about, numbering them in
+    listing order. Files in the cache go straight to the aggregate
+    stage, the rest are queued to be fetched"""
+    index = 0
+    for entry in files:
         org_name = entry['key_name'].split('/')[0]
-        node_data_type = normalize_node_name(entry['key_name'])
-        if not node_data_type:
-            print "Unable to figure out data type for %s, skipping" % entry['key_name']
+        # check if it's a tsv or json file
+        data_type = key_data_type(entry['key_name'])
+        if data_type:
+            # check if it's a file we care about
+            node_data_type = normalize_node_name(entry['key_name'])
+            if not node_data_type:
+                print "Unable to figure out data type for %s, skipping" % entry['key_name']
+                continue
+            key_name = entry['key_name']
+            version = object_version(entry)
+            tasks[index] = (org_name, node_data_type, key_name, version)
+            if metrics:
+                metrics.record_object(key_name,
+                                      org=org_name,
+                                      node=node_data_type,
+                                      cached=False)
+            summary = None
+            if cache:
+                summary = cache.get(key_name, version,
+                                    wanted_columns(node_data_type,
+                                                   collect_values,
+                                                   unique_ids))
+            if summary is not None:
+                print "Using cached results for %s" % key_name
+                if metrics:
+                    metrics.record_object(key_name, cached=True)
+                put_item(results, ('summary', index, summary), stop)
+            else:
+                put_item(fetch_queue,
+                         (index, node_data_type, key_name, data_type),
+                         stop)
+            index += 1
+        elif validation_file in entry['key_name']:
+            print "Validation file found"
+            put_item(results, ('validated', org_name), stop)
+
+    put_item(results, ('listed', index), stop)
+
+def fetch_stage(backend, collect_values, unique_ids, policy, fetch_queue,
+                parse_queue, results, stop):
+    """Reads queued objects, retrying those that fail as the policy
+    says with a delay that doubles each time. The aggregate stage is
+    told of each retry so it drops blocks of the failed attempt, and
+    of objects skipped after failing every attempt"""
+    while True:
+        index, node_data_type, key_name, data_type = \
+            get_item(fetch_queue, stop)
+        print "Loading %s" % key_name
+        start = time.time()
+        stats = {'bytes': 0,
+                 'fetch_seconds': 0.0,
+                 'retries': 0,
+                 'hedged': 0}
+        columns = wanted_columns(node_data_type, collect_values, unique_ids)
+        block_count = None
+        for attempt in range(policy.retries + 1):
+            try:
+                block_count = fetch_object(backend, policy, index, attempt,
+                                           node_data_type, key_name, data_type,
+                                           columns, stats, parse_queue, stop)
+                break
+            except PipelineStopped:
+                raise
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+                if attempt == policy.retries:
+                    print "Skipping %s after %d attempts, %s" % (key_name,
+                                                                 attempt + 1,
+                                                                 error)
+                    put_item(results, ('failed', index, error, stats), stop)
+                    break
+                delay = policy.retry_delay(attempt)
+                print "Retrying %s in %.1fs, %s" % (key_name, delay, error)
+                stats['retries'] += 1
+                put_item(results, ('retry', index, attempt + 1), stop)
+                if stop.wait(delay):
+                    raise PipelineStopped()
+        if block_count is not None:
+            put_item(results,
+                     ('fetched', index, attempt, block_count, start, stats),
+                     stop)
+
+def fetch_object(backend, policy, index, attempt, node_data_type, key_name,
+                 data_type, columns, stats, parse_queue, stop):
+    """Reads an object in blocks of whole lines, returning how many
+    blocks were queued to be parsed. The format of a tsv is sniffed
+    from the first chunk and passed on with each block. Blocks after
+    the one with the header get the header line put back in front, so
+    each parses the same as it would within the file. A json document
+    is read as one block, it can't be split on lines. Compressed
+    objects are decompressed as they are read"""
+    header = None
+    document = None
+    block_count = 0
+    fetched = fetch_chunks(backend, key_name, policy, stats, stop)
+    try:
+        chunks = decompress_chunks(fetched)
+        text_format = None
+        if data_type in data_delimiters:
+            chunks, text_format = sniff_chunks(chunks,
+                                               data_delimiters[data_type])
+        for block in read_blocks(chunks, parse_block_size,
+                                 text_format and text_format.quotechar):
+            if data_type == 'json':
+                if document is None:
+                    document = block if is_json_document(block) else False
+                elif document:
+                    document.extend(block)
+                if document:
+                    continue
+            elif header is None:
+                header = find_header(block, text_format)
+            else:
+                block.insert(0, header + '\n')
+            put_item(parse_queue,
+                     (index, attempt, block_count, node_data_type, data_type,
+                      text_format, columns, block),
+                     stop)
+            block_count += 1
+            del block
+        if document:
+            put_item(parse_queue,
+                     (index, attempt, block_count, node_data_type, data_type,
+                      text_format, columns, document),
+                     stop)
+            block_count += 1
+            del document
+    finally:
+        # a failed read has to let go of its readers now, not once
+        # the traceback holding on to it is gone
+        fetched.close()
+    return block_count
+
+def parse_stage(process_pool, parse_queue, results, stop):
+    """Summarizes queued blocks, in the process pool if there is one"""
+    while True:
+        (index, attempt, block_number, node_data_type, data_type,
+         text_format, columns, block) = get_item(parse_queue, stop)
+        start = time.time()
+        if process_pool:
+            summary = process_pool.apply(summarize_data,
+                                         (node_data_type, block, columns,
+                                          data_type, text_format))
         else:
-            # load the data
-            print "Loading %s" % entry['key_name']
-            data = s3_inst.load_file(conn=s3_conn,
-                                     bucket_name=bucket_name,
-                                 key_name=entry['key_name'])
-
-            file_data = parse_data_file(data, file_type)
-
-            if org_name not in all_org_data:
-                all_org_data[org_name] = dict(default_data)
-            if all_org_data[org_name][node_data_type]:
+            summary = summarize_data(node_data_type, block, columns,
+                                     data_type, text_format)
+        del block
+        put_item(results,
+                 ('parsed', index, attempt, block_number, summary,
+                  time.time() - start),
+                 stop)
+
+def load_org_data(backend, files,
+                  workers=default_fetch_workers,
+                  collect_values=True,
+                  cache=None,
+                  parse_processes=0,
+                  metrics=None,
+                  parse_workers=None,
+                  queue_depth=default_queue_depth,
+                  unique_ids=False,
+                  memory_budget=None,
+                  spill_dir=None,
+                  fetch_policy=None):
+    """Summarizes every file we care about in the bucket listing
+    through a pipeline of list, fetch, parse and aggregate stages
+    joined by bounded queues, so downloads overlap with parsing and
+    memory is bounded by the queue depth rather than the bucket. The
+    fetch and parse stages run on workers and parse_workers threads.
+    Objects are read and parsed in blocks, and the summaries are
+    applied in listing order, so the result does not depend on the
+    order the work finishes in.
+    Without collect_values only row counts are gathered, with
+    unique_ids the distinct ids of each file are counted too. With
+    parse_processes the parsing is done in a pool of processes,
+    unless the listing shows too little to fetch for that to pay off.
+    With a memory_budget in megabytes the aggregates are returned in
+    a SpilledAggregates, which spills them to spill_dir past that,
+    counting the summaries the cache holds against the budget too.
+    Objects are fetched with the timeouts, retries and hedging of the
+    fetch_policy, and those that fail every attempt are left out"""
+    all_org_data = new_aggregates(memory_budget, spill_dir, cache)
+    tasks = {}
+    # summaries finish in any order, hold on to the early ones
+    # until everything listed before them has been applied
+    pending = {}
+    objects = {}
+    # the attempt each retried object is on
+    retried = {}
+
+    def org_aggregate(org_name):
+        if org_name in all_org_data:
+            return all_org_data[org_name]
+        return OrgAggregate()
+
+    def apply_ready(next_index):
+        while next_index in pending:
+            org_name, node_data_type, key_name, version = tasks.pop(next_index)
+            summary = pending.pop(next_index)
+            next_index += 1
+            if summary is None:
+                # the object was skipped
+                continue
+            if not unique_ids:
+                # a cached summary may have them from a run counting them
+                summary.pop('ids', None)
+            aggregate = org_aggregate(org_name)
+            if aggregate.add_file(node_data_type, summary):
                 print "Warning, overwriting existing data for %s" % node_data_type
-            all_org_data[org_name][node_data_type] = file_data
-    elif validation_file in entry['key_name']:
-        print "Validation file found"
-        if org_name not in all_org_data:
-            all_org_data[org_name] = dict(default_data)
-        all_org_data[org_name][validated_key] = True
+            # stored again for a budget to see what it takes now
+            all_org_data[org_name] = aggregate
+        return next_index
+
+    def object_state(index):
+        if index not in objects:
+            org_name, node_data_type, key_name, version = tasks[index]
+            columns = wanted_columns(node_data_type, collect_values,
+                                     unique_ids)
+            objects[index] = {'summary': count_summary(0, columns),
+                              'parsed': 0,
+                              'first_row_block': None,
+                              'parse_seconds': 0.0,
+                              'block_count': None}
+        return objects[index]
+
+    def object_done(index):
+        # all blocks of an object are parsed once we know how many
+        # there are and have them all
+        state = objects[index]
+        if state['block_count'] is None or state['parsed'] < state['block_count']:
+            return
+        del objects[index]
+        org_name, node_data_type, key_name, version = tasks[index]
+        summary = state['summary']
+        if cache:
+            cache.put(key_name, version, summary)
+        if metrics:
+            seconds = time.time() - state['start']
+            metrics.record_object(key_name,
+                                  seconds=seconds,
+                                  fetch_seconds=state['fetch_seconds'],
+                                  parse_seconds=state['parse_seconds'],
+                                  bytes=state['bytes'],
+                                  rows=summary['rows'],
+                                  skipped=summary.get('skipped', 0),
+                                  retries=state['retries'],
+                                  hedged=state['hedged'])
+        pending[index] = summary
+
+    if fetch_policy is None:
+        fetch_policy = FetchPolicy()
+    process_pool = None
+    if parse_processes > 0:
+        # a listing read as the ingest goes is only read ahead as far
+        # as it takes to tell whether there is enough to fetch
+        listed = []
+        fetch_bytes = 0
+        files = iter(files)
+        for entry in files:
+            listed.append(entry)
+            fetch_bytes += entry.get('size') or 0
+            if fetch_bytes >= min_process_parse_bytes:
+                break
+        files = chain(listed, files)
+        if fetch_bytes >= min_process_parse_bytes:
+            # only imported when used, it adds to every start up
+            from multiprocessing import Pool
+            process_pool = Pool(parse_processes)
+        else:
+            print "Only %d bytes to fetch, parsing on threads" % fetch_bytes
+    if not parse_workers:
+        parse_workers = max(default_parse_workers, parse_processes)
+
+    stop = threading.Event()
+    fetch_queue = Queue.Queue(queue_depth)
+    parse_queue = Queue.Queue(queue_depth)
+    results = Queue.Queue(queue_depth)
+    stages = [(list_stage, (files, collect_values, unique_ids, cache,
+                            metrics, tasks, fetch_queue, results, stop), 1),
+              (fetch_stage, (backend, collect_values, unique_ids,
+                             fetch_policy, fetch_queue, parse_queue,
+                             results, stop),
+               workers),
+              (parse_stage, (process_pool, parse_queue, results, stop),
+               parse_workers)]
+    threads = []
+    for stage, stage_args, count in stages:
+        for worker in range(max(1, count)):
+            thread = threading.Thread(target=run_stage,
+                                      args=(stage, results, stop) + stage_args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+    try:
+        listed = None
+        next_index = 0
+        while listed is None or next_index < listed:
+            message = get_item(results, stop)
+            kind = message[0]
+            if kind == 'error':
+                exc_info = message[1]
+                raise exc_info[0], exc_info[1], exc_info[2]
+            elif kind == 'listed':
+                listed = message[1]
+            elif kind == 'validated':
+                org_name = message[1]
+                aggregate = org_aggregate(org_name)
+                aggregate.validated = True
+                all_org_data[org_name] = aggregate
+            elif kind == 'summary':
+                pending[message[1]] = message[2]
+            elif kind == 'retry':
+                # start the object over, blocks of earlier attempts
+                # still to come are dropped
+                index, attempt = message[1:]
+                objects.pop(index, None)
+                retried[index] = attempt
+            elif kind == 'failed':
+                index, error, stats = message[1:]
+                objects.pop(index, None)
+                # blocks of the last attempt may still be on their way
+                retried[index] = fetch_policy.retries + 1
+                if metrics:
+                    metrics.record_object(tasks[index][2],
+                                          error=error,
+                                          bytes=stats['bytes'],
+                                          retries=stats['retries'],
+                                          hedged=stats['hedged'])
+                pending[index] = None
+            elif kind == 'fetched':
+                index, attempt, block_count, start, stats = message[1:]
+                if index not in tasks or attempt < retried.get(index, 0):
+                    continue
+                state = object_state(index)
+                state.update(block_count=block_count,
+                             start=start,
+                             fetch_seconds=stats['fetch_seconds'],
+                             bytes=stats['bytes'],
+                             retries=stats['retries'],
+                             hedged=stats['hedged'])
+                object_done(index)
+            elif kind == 'parsed':
+                index, attempt, block_number, summary, seconds = message[1:]
+                # blocks are folded in as they come rather than held
+                # on to, the first row of a project is the earliest one
+                if index not in tasks or attempt < retried.get(index, 0):
+                    continue
+                state = object_state(index)
+                add_summary(state['summary'], summary)
+                if 'first_row' in summary and \
+                        (state['first_row_block'] is None or
+                         block_number < state['first_row_block']):
+                    state['summary']['first_row'] = summary['first_row']
+                    state['first_row_block'] = block_number
+                state['parsed'] += 1
+                state['parse_seconds'] += seconds
+                object_done(index)
+            next_index = apply_ready(next_index)
+    except BaseException:
+        close_aggregates(all_org_data)
+        raise
+    finally:
+        # the stages see this within queue_poll_seconds and return
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if process_pool:
+            process_pool.terminate()
+            process_pool.join()
+
+    return all_org_data
 
 
-matrix_file_name = 'matrix.html'
-matrix_2_file_name = 'matrix2.html'
-nginx_loc = '/usr/share/nginx/html/'
+def print_dict(cur_dict):
+    for key, value in cur_dict.iteritems():
+        print key
+        for key2 in count_slots:
+            if value.count(key2):
+                print "\t%s: %d" % (key2, value.count(key2))
+        if value.validated:
+            print "\t%s: %r" % (validated_key, value.validated)
+
+
+
+def open_backend(args):
+    """The storage backend the arguments ask for"""
+    if args.local_dir:
+        return LocalBackend(args.local_dir)
+    # occlibs is only needed for the object store, and slow to import
+    from occlibs.s3_wrapper import S3_Wrapper
+    return S3Backend(S3_Wrapper(),
+                     os.environ['S3_OBJECT_STORE'],
+                     os.environ['S3_BUCKET'])
+
+def wanted_org(org_name, include=None, exclude=None, shard=None):
+    """Whether to read an organization, by the start of its prefix and
+    the shard, given as (index, count), it falls in"""
+    if include and not any(org_name.startswith(prefix) for prefix in include):
+        return False
+    if exclude and any(org_name.startswith(prefix) for prefix in exclude):
+        return False
+    if shard and org_shard(org_name, shard[1]) != shard[0]:
+        return False
+    return True
+
+def iter_listing(backend, workers=default_list_workers, include=None,
+                 exclude=None, shard=None):
+    """Yields the listing of the organizations wanted a prefix at a
+    time, in key order, while the prefixes after it are listed on
+    worker threads, so work on the first can start straight away.
+    Organizations that aren't wanted are never listed"""
+    top_level = backend.list_top_level()
+    if top_level is None:
+        # a single listing of everything it is then
+        for entry in backend.list():
+            if wanted_org(entry['key_name'].split('/')[0], include, exclude, shard):
+                yield entry
+        return
+
+    prefixes, files = top_level
+    for entry in files:
+        if wanted_org(entry['key_name'], include, exclude, shard):
+            yield entry
+    prefixes = [prefix for prefix in prefixes
+                if wanted_org(prefix.rstrip('/'), include, exclude, shard)]
+    if not prefixes:
+        return
+    # only imported when used, it adds to every start up
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(workers, len(prefixes))))
+    try:
+        for files in pool.imap(backend.list, prefixes):
+            for entry in files:
+                yield entry
+    finally:
+        pool.terminate()
+        pool.join()
+
+def recorded(entries, into, metrics):
+    """Passes entries through, keeping them in into as they go by. The
+    time spent waiting on the listing goes in the list phase of metrics,
+    since the ingest can't move on without it"""
+    entries = iter(entries)
+    while True:
+        with metrics.phase('list'):
+            entry = next(entries, None)
+        if entry is None:
+            return
+        into.append(entry)
+        yield entry
+
+def org_shard(org_name, shard_count):
+    """The shard an organization's prefix falls in, the same on every
+    host and run"""
+    return (zlib.crc32(org_name) & 0xffffffff) % shard_count
+
+def data_files(files):
+    """The listed files that are summarized into the matrices"""
+    return [entry for entry in files
+            if key_data_type(entry['key_name']) and
+            normalize_node_name(entry['key_name'])]
+
+def write_partial(file_name, shard, all_org_data, files, collect_values):
+    """Saves what a shard found for the merge command"""
+    partial = {'version': partial_version,
+               'shard': shard,
+               'collect_values': collect_values,
+               'orgs': dict(all_org_data.iteritems()),
+               'files': data_files(files)}
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'wb') as out_file:
+        cPickle.dump(partial, out_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_name, file_name)
+
+def read_partials(file_names, memory_budget=None, spill_dir=None):
+    """Combines the partial files of every shard of a run, returning
+    the aggregates of all organizations, the data files listed and
+    whether secondary matrix values were collected. Fails unless each
+    shard is there exactly once. The aggregates are kept within a
+    memory_budget in megabytes as the ingest would"""
+    all_org_data = new_aggregates(memory_budget, spill_dir)
+    files = []
+    collect_values = True
+    shards = set()
+    shard_count = None
+    try:
+        for file_name in file_names:
+            with open(file_name, 'rb') as in_file:
+                partial = cPickle.load(in_file)
+            if partial.get('version') != partial_version:
+                raise ValueError('%s is not a partial file this version can read' % file_name)
+            index, count = partial['shard']
+            if shard_count is None:
+                shard_count = count
+            if count != shard_count:
+                raise ValueError('%s is shard %d/%d, expected shards of %d' %
+                                 (file_name, index, count, shard_count))
+            if index in shards:
+                raise ValueError('shard %d/%d given more than once' % (index, count))
+            shards.add(index)
+            for org_name, aggregate in partial['orgs'].iteritems():
+                all_org_data[org_name] = aggregate
+            files.extend(partial['files'])
+            collect_values = collect_values and partial['collect_values']
+            del partial
+        missing = sorted(set(range(shard_count or 0)) - shards)
+        if missing:
+            raise ValueError('missing shards %s of %d' %
+                             (', '.join(str(index) for index in missing), shard_count))
+    except BaseException:
+        close_aggregates(all_org_data)
+        raise
+
+    return all_org_data, files, collect_values
+
+def publish(args, all_org_data, files, metrics, collect_values=True):
+    """Writes out the pages, snapshot and history the arguments ask for
+    from the aggregates of every organization"""
+    create_main_matrix = (args.create_all_matrices or
+                          not args.create_secondary_matrix)
+    create_secondary_matrix = (args.create_all_matrices or
+                               args.create_secondary_matrix)
+    if create_secondary_matrix and not collect_values:
+        print "No values were collected for the secondary matrix, skipping it"
+        create_secondary_matrix = False
+
+    file_names = []
+    with metrics.phase('render'):
+        matrix_2_data = None
+        if create_main_matrix:
+            output_main_matrix_table(all_org_data, matrix_file_name)
+            file_names.append(matrix_file_name)
+        if create_secondary_matrix:
+            matrix_2_data = process_parsed_data(all_org_data)
+            output_detailed_matrix_table(matrix_2_data, matrix_2_file_name)
+            file_names.append(matrix_2_file_name)
+        snapshot = None
+        if not args.no_snapshot or not args.no_history:
+            snapshot = build_snapshot(all_org_data, matrix_2_data)
+        if not args.no_snapshot:
+            write_snapshot_json(snapshot, args.snapshot_json)
+            file_names.append(args.snapshot_json)
+            if args.snapshot_csv:
+                write_snapshot_csv(snapshot, args.snapshot_csv)
+                file_names.append(args.snapshot_csv)
+
+    if not args.no_history:
+        with metrics.phase('history'):
+            history = RunHistory(args.history_db)
+            try:
+                history.add_run(snapshot, data_files(files))
+                history.compact(args.history_keep_days,
+                                args.history_daily_after_days)
+            finally:
+                history.close()
+
+    if args.copy_file_to_server:
+        with metrics.phase('copy'):
+            for file_name in file_names:
+                server_name = nginx_loc + os.path.basename(file_name)
+                print "Copying %s to %s" % (file_name, server_name)
+                shutil.copyfile(file_name, server_name)
+
+def report_metrics(args, metrics):
+    metrics.print_summary(args.slowest)
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json, args.slowest)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+
+def run(args, backend=None, metrics=None):
+    """Builds the matrices the arguments ask for from the backend, or
+    the one they name, writing out the pages, snapshot and history.
+    With a shard, only its organizations are processed and written to
+    a partial file instead. Returns the aggregated data of every
+    organization processed, which with a memory budget is to be closed
+    with close_aggregates once done with"""
+    if backend is None:
+        backend = open_backend(args)
+    if metrics is None:
+        metrics = RunMetrics()
+    # the listing is read as the ingest goes, and kept for the history
+    files = []
+    listing = recorded(iter_listing(backend, args.list_workers,
+                                    args.include_prefix, args.exclude_prefix,
+                                    args.shard),
+                       files, metrics)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_file, rebuild=args.rebuild_cache)
+
+    # the main matrix only needs row counts
+    collect_values = args.create_all_matrices or args.create_secondary_matrix
+    with metrics.phase('ingest'):
+        all_org_data = load_org_data(backend, listing,
+                                     workers=args.fetch_workers,
+                                     collect_values=collect_values,
+                                     cache=cache,
+                                     parse_processes=args.parse_processes,
+                                     metrics=metrics,
+                                     parse_workers=args.parse_workers,
+                                     queue_depth=args.queue_depth,
+                                     unique_ids=args.unique_ids,
+                                     memory_budget=args.memory_budget,
+                                     spill_dir=args.spill_dir,
+                                     fetch_policy=FetchPolicy(args.fetch_timeout,
+                                                              args.fetch_retries,
+                                                              args.retry_backoff,
+                                                              args.hedge_percentile))
+    try:
+        if cache:
+            with metrics.phase('cache'):
+                cache.save(lambda org_name: wanted_org(org_name,
+                                                       args.include_prefix,
+                                                       args.exclude_prefix,
+                                                       args.shard))
+
+        if args.shard:
+            partial_file = args.partial_file or default_partial_file % args.shard
+            with metrics.phase('partial'):
+                write_partial(partial_file, args.shard, all_org_data, files,
+                              collect_values)
+            print "Wrote shard %d/%d to %s" % (args.shard + (partial_file,))
+        else:
+            publish(args, all_org_data, files, metrics, collect_values)
+    except BaseException:
+        close_aggregates(all_org_data)
+        raise
+    finally:
+        # the objects skipped matter most when the run fails
+        report_metrics(args, metrics)
+
+    #print_dict(all_org_data)
+    return all_org_data
+
+def merge(args, metrics=None):
+    """Publishes the matrices from the partial files of a sharded run,
+    returning the aggregated data of every organization, to be closed
+    as run's is"""
+    if metrics is None:
+        metrics = RunMetrics()
+    with metrics.phase('merge'):
+        all_org_data, files, collect_values = read_partials(args.partials,
+                                                            args.memory_budget,
+                                                            args.spill_dir)
+    try:
+        publish(args, all_org_data, files, metrics, collect_values)
+    except BaseException:
+        close_aggregates(all_org_data)
+        raise
+    report_metrics(args, metrics)
+    return all_org_data
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['history']:
+        return history_command(argv[1:])
+    if argv[:1] == ['merge']:
+        all_org_data = merge(parse_cmd_args(argv[1:], merge=True))
+    else:
+        all_org_data = run(parse_cmd_args(argv))
+    close_aggregates(all_org_data)
+    return 0
+
 
-if not args.create_secondary_matrix:
-    new_org_data = sum_parsed_data(all_org_data)
-    #org_name = 'BPA_PersonalGenome_Beta1'
-    #print '\n***Totals for {}***'.format(org_name)
-    #for key in new_org_data[org_name].keys():
-    #    if type(new_org_data[org_name][key]) != bool:
-    #        print key, len(new_org_data[org_name][key])
-    output_main_matrix_table(new_org_data, matrix_file_name)
-    file_name = matrix_file_name
-else:
-    matrix_2_data = process_parsed_data(all_org_data)
-    output_detailed_matrix_table(matrix_2_data, matrix_2_file_name)
-    file_name = matrix_2_file_name
-
-if args.copy_file_to_server:
-    print "Copying %s to %s" % (file_name,
-        nginx_loc + file_name)
-    shutil.copyfile(file_name, nginx_loc + file_name)
-
-#print_dict(new_org_data)
+if __name__ == '__main__':
+    # run from the module as imported, so what is pickled names its
+    # classes as matrix rather than __main__ and loads from either
+    import matrix
+    sys.exit(matrix.main())
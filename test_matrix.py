@@ -0,0 +1,668 @@
+#!/usr/bin/env python
+
+import os, sys
+import bz2
+import gzip
+import gc
+import json
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import matrix
+
+def write_bucket(root, objects):
+    for key_name, data in objects.iteritems():
+        path = os.path.join(root, key_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+
+def tsv(node, rows):
+    lines = ['submitter_id\ttype\tvolume']
+    lines += ['%s-%d\t%s\t%d' % (node, row, node, row % 5) for row in range(rows)]
+    return '\n'.join(lines) + '\n'
+
+class HalfReadBackend(matrix.LocalBackend):
+    """Fails every read of broken_key halfway through the object, and
+    is slow to open the others"""
+
+    def __init__(self, root, broken_key):
+        matrix.LocalBackend.__init__(self, root)
+        self.broken_key = broken_key
+
+    def open(self, key_name):
+        handle = matrix.LocalBackend.open(self, key_name)
+        if key_name != self.broken_key:
+            time.sleep(3)
+            return handle
+        return HalfReadHandle(handle.read(len(handle)))
+
+class HalfReadHandle(object):
+
+    def __init__(self, data):
+        self.handle = StringIO(data[:len(data) // 2])
+
+    def read(self, size):
+        data = self.handle.read(min(size, 64))
+        if not data:
+            raise IOError('connection reset')
+        return data
+
+    def close(self):
+        pass
+
+class SlowFirstOpenBackend(matrix.LocalBackend):
+    """The first request for an object takes a while to answer, and
+    every request reads it slowly, a little at a time"""
+
+    def __init__(self, root):
+        matrix.LocalBackend.__init__(self, root)
+        self.handles = []
+
+    def open(self, key_name):
+        handle = matrix.LocalBackend.open(self, key_name)
+        handle = CountingHandle(handle.read(len(handle)),
+                                0.2 if not self.handles else 0)
+        self.handles.append(handle)
+        return handle
+
+class CountingHandle(object):
+
+    def __init__(self, data, first_delay):
+        self.handle = StringIO(data)
+        self.first_delay = first_delay
+        self.sent = 0
+
+    def read(self, size):
+        time.sleep(self.first_delay if not self.sent else 0.001)
+        data = self.handle.read(min(size, 64))
+        self.sent += len(data)
+        return data
+
+    def close(self):
+        pass
+
+class CountingS3(object):
+    """Stands in for occlibs' S3_Wrapper over a dict of objects,
+    counting the connections made"""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def connect_to_s3(self, object_store):
+        with self.lock:
+            self.connections += 1
+        return object()
+
+    def get_files_in_s3_bucket(self, conn, bucket_name):
+        return [{'key_name': key_name,
+                 'size': len(data),
+                 'etag': None,
+                 'last_modified': None}
+                for key_name, data in sorted(self.objects.iteritems())]
+
+    def load_file(self, conn, bucket_name, key_name):
+        return self.objects[key_name]
+
+def gzipped(data):
+    out_file = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=out_file, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return out_file.getvalue()
+
+def in_chunks(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+def project(org):
+    return 'submitter_id\ttype\tname\n%s\tproject\tProject %s\n' % (
+        org.replace('_', '-'), org)
+
+def org_objects(orgs, rows=20):
+    """A bucket of organizations with a project, cases and samples of
+    their own sizes, every other one validated"""
+    objects = {}
+    for number, org in enumerate(orgs):
+        objects[org + '/project.tsv'] = project(org)
+        objects[org + '/cases.tsv'] = tsv('cases', rows + number)
+        objects[org + '/samples.tsv'] = tsv('samples', 2 * rows + number)
+        if number % 2:
+            objects[org + '/' + matrix.validation_file] = ''
+    return objects
+
+class FailingOpenBackend(matrix.LocalBackend):
+    """Fails to open every key ending in one of failing"""
+
+    def __init__(self, root, failing):
+        matrix.LocalBackend.__init__(self, root)
+        self.failing = failing
+
+    def open(self, key_name):
+        if key_name.endswith(tuple(self.failing)):
+            raise IOError('service unavailable')
+        return matrix.LocalBackend.open(self, key_name)
+
+class QuietTestCase(unittest.TestCase):
+    """Keeps the per file progress out of the test output"""
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.root)
+
+class RunTestCase(QuietTestCase):
+    """Runs the matrix over a bucket under root, writing its pages
+    and snapshot there"""
+
+    def setUp(self):
+        QuietTestCase.setUp(self)
+        self.bucket = os.path.join(self.root, 'bucket')
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        QuietTestCase.tearDown(self)
+
+    def run_matrix(self, *argv, **kwargs):
+        args = matrix.parse_cmd_args(['--local_dir', self.bucket,
+                                      '--no_history'] + list(argv))
+        matrix.close_aggregates(matrix.run(args, kwargs.get('backend')))
+
+    def page(self, file_name):
+        with open(file_name) as in_file:
+            return in_file.read().split('Last processed')[0]
+
+    def snapshot(self):
+        with open(matrix.default_snapshot_file) as in_file:
+            snapshot = json.load(in_file)
+        del snapshot['generated']
+        return snapshot
+
+class FetchFailureTest(QuietTestCase):
+
+    def setUp(self):
+        QuietTestCase.setUp(self)
+        self.saved = matrix.parse_block_size, matrix.summarize_data
+        matrix.parse_block_size = 50
+
+    def tearDown(self):
+        matrix.parse_block_size, matrix.summarize_data = self.saved
+        QuietTestCase.tearDown(self)
+
+    def test_object_failing_mid_stream_is_skipped(self):
+        objects = {}
+        for org in ['BPA_OrgA_P0001', 'BPA_OrgB_P0002']:
+            for node in ['aliquots', 'cases', 'samples']:
+                objects['%s/%s.tsv' % (org, node)] = tsv(node, 40)
+        broken_key = 'BPA_OrgA_P0001/aliquots.tsv'
+        objects[broken_key] = tsv('aliquots', 400)
+        write_bucket(self.root, objects)
+        backend = HalfReadBackend(self.root, broken_key)
+
+        # parsing slower than fetching leaves blocks of the last
+        # attempt to arrive after the object has been given up on,
+        # while the others are still being fetched
+        summarize_data = self.saved[1]
+        def slow_summarize_data(node_data_type, *args):
+            if node_data_type == 'aliquot':
+                time.sleep(0.05)
+            return summarize_data(node_data_type, *args)
+        matrix.summarize_data = slow_summarize_data
+
+        metrics = matrix.RunMetrics()
+        policy = matrix.FetchPolicy(timeout=5, retries=0)
+        all_org_data = matrix.load_org_data(backend, backend.list(),
+                                            metrics=metrics,
+                                            fetch_policy=policy,
+                                            queue_depth=2)
+
+        self.assertEqual(all_org_data['BPA_OrgA_P0001'].count('aliquot'), 0)
+        self.assertEqual(all_org_data['BPA_OrgA_P0001'].count('case'), 40)
+        self.assertEqual(all_org_data['BPA_OrgB_P0002'].count('case'), 40)
+        self.assertIn('connection reset',
+                      metrics.objects[broken_key]['error'])
+
+class SkippedProjectTest(RunTestCase):
+
+    def test_run_publishes_without_a_project(self):
+        objects = {}
+        for org in ['BPA_OrgA_P0001', 'BPA_OrgB_P0002']:
+            objects[org + '/project.tsv'] = project(org)
+            objects[org + '/cases.tsv'] = tsv('cases', 10)
+        write_bucket(self.bucket, objects)
+        backend = FailingOpenBackend(self.bucket, ['OrgA_P0001/project.tsv'])
+        sys.stdout.close()
+        sys.stdout = output = StringIO()
+
+        self.run_matrix('--create_all_matrices', '--fetch_retries', '0',
+                        backend=backend)
+
+        organizations = self.snapshot()['organizations']
+        self.assertEqual(organizations['BPA_OrgA_P0001']['project'], 'unknown')
+        self.assertEqual(organizations['BPA_OrgA_P0001']['counts']['case'], 10)
+        self.assertEqual(organizations['BPA_OrgB_P0002']['project'], 'P0002')
+        self.assertIn('OrgA', self.page(matrix.matrix_file_name))
+        self.assertIn('1 objects skipped after failing every attempt',
+                      output.getvalue())
+
+class UniqueIdsTest(RunTestCase):
+
+    def test_cached_ids_are_left_out_without_the_flag(self):
+        objects = {}
+        for org in ['BPA_OrgA_P0001', 'BPA_OrgB_P0002']:
+            objects[org + '/project.tsv'] = project(org)
+            objects[org + '/cases.tsv'] = tsv('cases', 20)
+            objects[org + '/samples.tsv'] = tsv('samples', 30)
+        write_bucket(self.bucket, objects)
+        self.run_matrix('--no_cache')
+        page, snapshot = self.page(matrix.matrix_file_name), self.snapshot()
+
+        self.run_matrix('--unique_ids')
+        self.assertIn('unique', self.page(matrix.matrix_file_name))
+        self.run_matrix()
+
+        self.assertEqual(self.page(matrix.matrix_file_name), page)
+        self.assertEqual(self.snapshot(), snapshot)
+
+class ShardTest(RunTestCase):
+
+    def test_merged_shards_match_a_single_run(self):
+        orgs = ['BPA_Org%s_P000%d' % (name, number)
+                for number, name in enumerate('ABCDEFGH')]
+        write_bucket(self.bucket, org_objects(orgs))
+        self.run_matrix('--create_all_matrices', '--unique_ids', '--no_cache')
+        pages = [self.page(matrix.matrix_file_name),
+                 self.page(matrix.matrix_2_file_name)]
+        snapshot = self.snapshot()
+        os.remove(matrix.matrix_file_name)
+
+        partials = []
+        for shard in range(3):
+            self.run_matrix('--create_all_matrices', '--unique_ids',
+                            '--shard', '%d/3' % shard)
+            partials.append(matrix.default_partial_file % (shard, 3))
+        self.assertFalse(os.path.exists(matrix.matrix_file_name))
+        matrix.main(['merge', '--create_all_matrices', '--no_history'] +
+                     partials)
+
+        self.assertEqual([self.page(matrix.matrix_file_name),
+                          self.page(matrix.matrix_2_file_name)], pages)
+        self.assertEqual(self.snapshot(), snapshot)
+
+    def test_merge_needs_every_shard(self):
+        write_bucket(self.bucket, org_objects(['BPA_OrgA_P0001',
+                                               'BPA_OrgB_P0002']))
+        self.run_matrix('--shard', '0/2')
+        self.assertRaises(ValueError, matrix.read_partials,
+                          [matrix.default_partial_file % (0, 2)])
+
+class DistinctValuesTest(unittest.TestCase):
+
+    def test_exact_up_to_the_limit(self):
+        values = matrix.DistinctValues(str(value) for value in
+                                       range(matrix.distinct_value_limit))
+        values.update(['0', '1'])
+        self.assertFalse(values.approximate)
+        self.assertEqual(len(values), matrix.distinct_value_limit)
+
+    def test_estimate_is_close(self):
+        errors = []
+        for trial in range(20):
+            values = matrix.DistinctValues('%d.%d' % (trial, value)
+                                           for value in range(20000))
+            self.assertTrue(values.approximate)
+            self.assertEqual(len(values.sketch), matrix.sketch_size)
+            errors.append(abs(len(values) - 20000) / 20000.0)
+        # about 1 / sqrt(sketch_size) on average
+        self.assertLess(sum(errors) / len(errors), 0.06)
+        self.assertLess(max(errors), 0.2)
+
+    def test_merged_sketches_match_one_of_everything(self):
+        first = matrix.DistinctValues('v%d' % value for value in range(30000))
+        second = matrix.DistinctValues('v%d' % value for value in range(15000, 50000))
+        exact = matrix.DistinctValues('v%d' % value for value in range(20000, 20010))
+        first.update(second)
+        first.update(exact)
+        everything = matrix.DistinctValues('v%d' % value for value in range(50000))
+        self.assertEqual(first.sketch, everything.sketch)
+        self.assertEqual(len(list(first)), matrix.sample_size)
+
+class ApproximateValuesTest(RunTestCase):
+
+    def test_page_shows_an_estimate(self):
+        objects = org_objects(['BPA_OrgA_P0001'])
+        objects['BPA_OrgA_P0001/samples.tsv'] = 'submitter_id\ttype\tvolume\n' + \
+            ''.join('sample-%d\tsample\t%d.5\n' % (row, row) for row in range(5000))
+        write_bucket(self.bucket, objects)
+
+        self.run_matrix('--create_all_matrices')
+
+        self.assertIn('distinct (approx.)', self.page(matrix.matrix_2_file_name))
+        organization = self.snapshot()['organizations']['BPA_OrgA_P0001']
+        estimate = organization['approximate_distinct']['volume']
+        self.assertLess(abs(estimate - 5000) / 5000.0, 0.2)
+        self.assertEqual(len(organization['values']['volume']), matrix.sample_size)
+
+class HedgeTest(QuietTestCase):
+
+    def test_losing_request_is_stopped(self):
+        key_name = 'BPA_OrgA_P0001/cases.tsv'
+        data = tsv('cases', 1000)
+        write_bucket(self.root, {key_name: data})
+        backend = SlowFirstOpenBackend(self.root)
+        policy = matrix.FetchPolicy(hedge_percentile=50)
+        for sample in range(matrix.min_hedge_samples):
+            policy.record_first_chunk(0.01)
+        stats = {'bytes': 0,
+                 'fetch_seconds': 0.0,
+                 'hedged': 0}
+
+        body = ''.join(matrix.fetch_chunks(backend, key_name, policy, stats,
+                                           threading.Event()))
+
+        self.assertEqual(body, data)
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['bytes'], len(data))
+        first, second = backend.handles
+        self.assertEqual(second.sent, len(data))
+        # the first request answered while the second was being read,
+        # and was stopped rather than read to the end
+        self.assertLess(first.sent, len(data) // 4)
+
+class ConnectionTest(QuietTestCase):
+
+    def test_objects_are_read_over_the_fetch_threads_connections(self):
+        objects = {}
+        for org in range(13):
+            for node in ['aliquots', 'cases', 'samples', 'demographics',
+                         'diagnoses']:
+                objects['BPA_Org%d_P0001/%s.tsv' % (org, node)] = tsv(node, 10)
+        s3 = CountingS3(objects)
+        backend = matrix.S3Backend(s3, 'store', 'bucket')
+
+        all_org_data = matrix.load_org_data(backend, backend.list(), workers=4)
+
+        self.assertEqual(all_org_data['BPA_Org12_P0001'].count('case'), 10)
+        # one for each fetch thread and the listing
+        self.assertLessEqual(s3.connections, 5)
+
+class ResultCacheTest(QuietTestCase):
+
+    def test_keys_of_unlisted_orgs_are_kept(self):
+        file_name = os.path.join(self.root, 'cache.pickle')
+        cache = matrix.ResultCache(file_name)
+        for key_name in ['BPA_OrgA_P0001/cases.tsv', 'BPA_OrgB_P0002/cases.tsv',
+                         'BPA_OrgB_P0002/samples.tsv']:
+            cache.get(key_name, ('etag', None, 10), [])
+            cache.put(key_name, ('etag', None, 10), {'columns': []})
+        cache.save()
+
+        # a run reading only OrgB, where its samples are no longer listed
+        cache = matrix.ResultCache(file_name)
+        cache.get('BPA_OrgB_P0002/cases.tsv', ('etag', None, 10), [])
+        cache.save(lambda org_name: matrix.wanted_org(org_name,
+                                                      include=['BPA_OrgB']))
+
+        cache = matrix.ResultCache(file_name)
+        self.assertEqual(sorted(cache.entries),
+                         ['BPA_OrgA_P0001/cases.tsv', 'BPA_OrgB_P0002/cases.tsv'])
+
+    def test_cache_written_from_the_command_line_loads_on_import(self):
+        bucket = os.path.join(self.root, 'bucket')
+        write_bucket(bucket, {'BPA_OrgA_P0001/project.tsv':
+                                  'submitter_id\ttype\nBPA-OrgA-P0001\tproject\n',
+                              'BPA_OrgA_P0001/cases.tsv': tsv('cases', 10)})
+        subprocess.check_call([sys.executable,
+                               os.path.abspath(matrix.__file__.replace('.pyc', '.py')),
+                               '--local_dir', bucket, '--no_history',
+                               '--unique_ids'],
+                              cwd=self.root, stdout=sys.stdout)
+
+        file_name = os.path.join(self.root, matrix.default_cache_file)
+        cache = matrix.ResultCache(file_name)
+        self.assertEqual(sorted(cache.entries), ['BPA_OrgA_P0001/cases.tsv',
+                                                 'BPA_OrgA_P0001/project.tsv'])
+        version, columns, data = cache.entries['BPA_OrgA_P0001/cases.tsv']
+        summary = cache.get('BPA_OrgA_P0001/cases.tsv', version, columns)
+        self.assertIsInstance(summary['ids'], matrix.IdHashSet)
+
+class SpillTest(QuietTestCase):
+
+    def test_spilled_orgs_are_released(self):
+        objects = {}
+        for org in range(6):
+            for node in ['aliquots', 'cases', 'samples']:
+                objects['BPA_Org%d_P0001/%s.tsv' % (org, node)] = tsv(node, 200)
+        write_bucket(self.root, objects)
+        backend = matrix.LocalBackend(self.root)
+        cache = matrix.ResultCache(os.path.join(self.root, 'cache.pickle'))
+
+        all_org_data = matrix.load_org_data(backend, backend.list(),
+                                            cache=cache, unique_ids=True,
+                                            memory_budget=0)
+        try:
+            gc.collect()
+            live = [obj for obj in gc.get_objects()
+                    if isinstance(obj, matrix.IdHashSet)]
+            self.assertEqual(len(all_org_data.resident), 1)
+            self.assertEqual(len(all_org_data.spilled), 5)
+            # only the ids of the organization still in memory are left
+            self.assertEqual(len(live), 3)
+            self.assertEqual(all_org_data['BPA_Org0_P0001'].unique_count('case'),
+                             200)
+        finally:
+            matrix.close_aggregates(all_org_data)
+
+    def test_cache_counts_against_the_budget(self):
+        cache = matrix.ResultCache(os.path.join(self.root, 'cache.pickle'))
+        cache.put('BPA_OrgA_P0001/cases.tsv', ('etag', None, 10),
+                  matrix.count_summary(10, ['submitter_id']))
+        aggregate = matrix.OrgAggregate()
+        # room for both aggregates, but not for the cache as well
+        all_org_data = matrix.SpilledAggregates(2 * aggregate.memory_size() +
+                                                cache.memory_size() // 2,
+                                                self.root, reserved=cache)
+        try:
+            all_org_data['BPA_OrgA_P0001'] = aggregate
+            all_org_data['BPA_OrgB_P0002'] = aggregate
+            self.assertGreater(cache.memory_size(), 0)
+            self.assertEqual(all_org_data.resident.keys(), ['BPA_OrgB_P0002'])
+        finally:
+            matrix.close_aggregates(all_org_data)
+
+class SpilledRunTest(RunTestCase):
+
+    def published(self):
+        return [self.page(matrix.matrix_file_name),
+                self.page(matrix.matrix_2_file_name),
+                self.snapshot()]
+
+    def test_spilled_run_matches_one_in_memory(self):
+        orgs = ['BPA_Org%s_P000%d' % (name, number)
+                for number, name in enumerate('ABCDEF')]
+        write_bucket(self.bucket, org_objects(orgs))
+        spill_dir = os.path.join(self.root, 'spill')
+        os.mkdir(spill_dir)
+        self.run_matrix('--create_all_matrices', '--unique_ids', '--no_cache')
+        published = self.published()
+
+        # the second run takes everything from the cache
+        for run in range(2):
+            self.run_matrix('--create_all_matrices', '--unique_ids',
+                            '--memory_budget', '0', '--spill_dir', spill_dir)
+            self.assertEqual(self.published(), published)
+            self.assertEqual(os.listdir(spill_dir), [])
+
+        for shard in range(2):
+            self.run_matrix('--create_all_matrices', '--unique_ids',
+                            '--shard', '%d/2' % shard)
+        matrix.main(['merge', '--create_all_matrices', '--no_history',
+                     '--memory_budget', '0', '--spill_dir', spill_dir] +
+                    [matrix.default_partial_file % (shard, 2)
+                     for shard in range(2)])
+        self.assertEqual(self.published(), published)
+        self.assertEqual(os.listdir(spill_dir), [])
+
+class ParseProcessesTest(QuietTestCase):
+
+    def setUp(self):
+        QuietTestCase.setUp(self)
+        self.saved = matrix.min_process_parse_bytes, multiprocessing.Pool
+        matrix.min_process_parse_bytes = 0
+
+    def tearDown(self):
+        matrix.min_process_parse_bytes, multiprocessing.Pool = self.saved
+        QuietTestCase.tearDown(self)
+
+    def test_one_process_parses_in_a_pool(self):
+        write_bucket(self.root, {'BPA_OrgA_P0001/cases.tsv': tsv('cases', 40)})
+        backend = matrix.LocalBackend(self.root)
+        pools = []
+        def Pool(processes):
+            pools.append(processes)
+            return self.saved[1](processes)
+        multiprocessing.Pool = Pool
+
+        all_org_data = matrix.load_org_data(backend, backend.list(),
+                                            parse_processes=1)
+
+        self.assertEqual(pools, [1])
+        self.assertEqual(all_org_data['BPA_OrgA_P0001'].count('case'), 40)
+
+class DelimitedFormatTest(QuietTestCase):
+
+    quoted = ('submitter_id\ttype\tnotes\n'
+              '"case-1"\tcase\t"a tab\tinside"\n'
+              '\n'
+              'stray line\n'
+              'case-2\tcase\t"a newline\ninside, and ""quotes"""\n'
+              '"case-3"\tcase\t\n')
+    single_column = 'submitter_id\ncase-1\ncase-2\n\ncase-3\n'
+
+    def parse(self, data):
+        return matrix.parse_data_file(data, 'tsv')
+
+    def count(self, data):
+        return matrix.count_data_rows([data], 'tsv')
+
+    def test_quoted_fields(self):
+        rows = self.parse(self.quoted)
+        self.assertEqual([row['submitter_id'] for row in rows],
+                         ['case-1', 'case-2', 'case-3'])
+        self.assertEqual(rows[0]['notes'], 'a tab\tinside')
+        self.assertEqual(rows[1]['notes'], 'a newline\ninside, and "quotes"')
+        self.assertEqual(self.count(self.quoted), len(rows))
+
+    def test_single_column(self):
+        rows = self.parse(self.single_column)
+        self.assertEqual([row['submitter_id'] for row in rows],
+                         ['case-1', 'case-2', 'case-3'])
+        self.assertEqual(self.count(self.single_column), len(rows))
+
+    def test_plain_rows_count_as_parsed(self):
+        data = tsv('cases', 50) + '\nstray line\n\t\n' + tsv('cases', 5)
+        self.assertEqual(self.count(data), len(self.parse(data)))
+
+    def test_blocks_split_outside_quoted_fields(self):
+        data = self.quoted + ''.join('case-%d\tcase\t"line\nline"\n' % row
+                                     for row in range(4, 200))
+        write_bucket(self.root, {'BPA_OrgA_P0001/cases.tsv': data})
+        backend = matrix.LocalBackend(self.root)
+        saved = matrix.parse_block_size
+        matrix.parse_block_size = 64
+        try:
+            for collect_values in [False, True]:
+                all_org_data = matrix.load_org_data(backend, backend.list(),
+                                                    collect_values=collect_values)
+                self.assertEqual(all_org_data['BPA_OrgA_P0001'].count('case'),
+                                 len(self.parse(data)))
+        finally:
+            matrix.parse_block_size = saved
+
+class DecompressTest(unittest.TestCase):
+
+    def test_streams_one_after_another_read_as_one_body(self):
+        parts = [tsv('cases', 300), tsv('cases', 1)[:-1], '\n' + tsv('cases', 700)]
+        data = ''.join(parts)
+        for body in [''.join(gzipped(part) for part in parts),
+                     ''.join(bz2.compress(part) for part in parts)]:
+            for size in [16, 1000, len(body)]:
+                self.assertEqual(
+                    ''.join(matrix.decompress_chunks(in_chunks(body, size))),
+                    data)
+
+    def test_uncompressed_body_is_passed_through(self):
+        chunks = in_chunks(tsv('cases', 100), 100)
+        self.assertEqual(list(matrix.decompress_chunks(chunks)), chunks)
+
+    def test_zero_padding_after_a_stream_ends_it(self):
+        data = tsv('cases', 1000)
+        for body in [gzipped(data) + '\0' * 100,
+                     bz2.compress(data) + '\0' * 100]:
+            for size in [16, 1000, len(body)]:
+                self.assertEqual(
+                    ''.join(matrix.decompress_chunks(in_chunks(body, size))),
+                    data)
+
+class CompressedObjectTest(QuietTestCase):
+
+    def test_compressed_objects_count_as_plain_ones(self):
+        cases = tsv('cases', 300)
+        samples = tsv('samples', 200)
+        aliquots = ''.join('{"submitter_id": "aliquot-%d", "type": "aliquot"}\n' % row
+                           for row in range(100))
+        write_bucket(self.root, {
+            'BPA_OrgA_P0001/cases.tsv': cases,
+            'BPA_OrgA_P0001/samples.tsv': samples,
+            'BPA_OrgA_P0001/aliquots.json': aliquots,
+            'BPA_OrgB_P0002/cases.tsv.gz': gzipped(cases),
+            'BPA_OrgB_P0002/samples.tsv.bz2': bz2.compress(samples),
+            'BPA_OrgB_P0002/aliquots.json.gz': gzipped(aliquots)})
+        backend = matrix.LocalBackend(self.root)
+        saved = matrix.parse_block_size
+        matrix.parse_block_size = 256
+        try:
+            for collect_values in [False, True]:
+                all_org_data = matrix.load_org_data(backend, backend.list(),
+                                                    collect_values=collect_values,
+                                                    unique_ids=True)
+                plain, compressed = (all_org_data['BPA_OrgA_P0001'],
+                                     all_org_data['BPA_OrgB_P0002'])
+                for node in ['case', 'sample', 'aliquot']:
+                    self.assertEqual(compressed.count(node), plain.count(node))
+                    self.assertEqual(compressed.unique_count(node),
+                                     plain.unique_count(node))
+                self.assertEqual(compressed.count('sample'), 200)
+                self.assertEqual(repr(compressed.values), repr(plain.values))
+        finally:
+            matrix.parse_block_size = saved
+
+class JsonFieldTest(unittest.TestCase):
+
+    def test_floats_keep_every_digit(self):
+        records = list(matrix.iter_json_records(
+            ['{"volume": 0.1234567890123456, "count": 12345678901234567}\n']))
+        self.assertEqual(matrix.json_field_value(records[0]['volume']),
+                         '0.1234567890123456')
+        self.assertEqual(matrix.json_field_value(records[0]['count']),
+                         '12345678901234567')
+        self.assertEqual(matrix.json_field_value(0.1), '0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()